@@ -0,0 +1,5 @@
+""" Benchmarks of pypns against local stand-ins of the push services
+
+    python -m benchmarks.codec        encoding and feedback decoding
+    python -m benchmarks.end_to_end   PNSServer over XML-RPC
+"""
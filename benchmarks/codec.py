@@ -0,0 +1,57 @@
+""" Microbenchmarks of the APNS encoding and feedback decoding hot paths
+
+    python -m benchmarks.codec [--count 100000] [--repeat 5]
+"""
+
+import os
+import time
+import binascii
+import optparse
+from pypns.apns.client import (
+    encode_notifications, COMMAND_SIMPLE, COMMAND_ENHANCED, COMMAND_FRAME)
+from pypns.server import decode_feedback
+from benchmarks.fake import encode_feedback
+
+def best_of(repeat, func, *args):
+    "The fastest of `repeat` runs of func(*args), in seconds"
+    best = None
+    for _ in xrange(repeat):
+        started = time.time()
+        func(*args)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, count, seconds):
+    print '%-40s %10d ops %8.3fs %12.0f ops/s' % (
+        name, count, seconds, count / seconds)
+
+def run(count, repeat):
+    tokens = [binascii.hexlify(os.urandom(32)) for _ in xrange(count)]
+    same = [{'aps': {'alert': 'Hello', 'badge': 1}}] * count
+    distinct = [{'aps': {'alert': 'Hello %d' % i}} for i in xrange(count)]
+    commands = [('simple', COMMAND_SIMPLE), ('enhanced', COMMAND_ENHANCED),
+                ('frame', COMMAND_FRAME)]
+    for name, command in commands:
+        report('encode_notifications %s same payload' % name, count,
+               best_of(repeat, encode_notifications, tokens, same,
+                       None, 0, command))
+        report('encode_notifications %s distinct' % name, count,
+               best_of(repeat, encode_notifications, tokens, distinct,
+                       None, 0, command))
+
+    feedback = encode_feedback(count)
+    report('decode_feedback', count, best_of(repeat, decode_feedback, feedback))
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option('--count', type='int', default=100000,
+                      help='notifications or feedback records per run')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='runs of every benchmark, the best one is reported')
+    options, args = parser.parse_args()
+    run(options.count, options.repeat)
+
+if __name__ == '__main__':
+    main()
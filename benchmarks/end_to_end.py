@@ -0,0 +1,143 @@
+""" Drives PNSServer over XML-RPC against the local fake gateways and
+reports notifications/sec, notify latency percentiles and peak RSS
+
+    python -m benchmarks.end_to_end [--provider apns|c2dm|wns]
+        [--notifications 100000]
+        [--batch 1000] [--concurrency 8] [--pool-size 1]
+"""
+
+import os
+import sys
+import time
+import binascii
+import optparse
+import resource
+from twisted.internet import reactor, defer
+from twisted.python import log
+from twisted.web import server, xmlrpc
+from pypns import base
+from pypns.server import PNSServer
+from benchmarks import fake
+
+APP_ID = 'benchmark'
+
+def percentile(values, q):
+    "The `q` quantile of the sorted `values`"
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def peak_rss():
+    "Peak resident set size of the process in MB"
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes elsewhere
+    return rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+def provision(provider, pem, ports, pool_size):
+    host = '127.0.0.1'
+    if provider == 'apns':
+        base.create_service(
+            APP_ID, 'apns', cert=pem, environment='sandbox',
+            pool_size=pool_size,
+            gateway_address=(host, ports['gateway'].getHost().port),
+            feedback_address=(host, ports['feedback'].getHost().port))
+    elif provider == 'c2dm':
+        url = 'http://%s:%d/' % (host, ports['c2dm'].getHost().port)
+        base.create_service(
+            APP_ID, 'c2dm', email='benchmark', password='benchmark',
+            environment='sandbox', url=url + 'send', login_url=url + 'login')
+    else:
+        # the fake speaks plain HTTP, so channels can't be held to WNS hosts
+        url = 'http://%s:%d/' % (host, ports['wns'].getHost().port)
+        base.create_service(
+            APP_ID, 'wns', client_id='benchmark', client_secret='benchmark',
+            login_url=url + 'token', channel_domain=None)
+
+def make_tokens(provider, ports, count):
+    "Hexlified APNS tokens or channel URIs of the fake WNS"
+    tokens = [binascii.hexlify(os.urandom(32)) for _ in xrange(count)]
+    if provider == 'wns':
+        url = 'http://127.0.0.1:%d/channel/' % ports['wns'].getHost().port
+        tokens = [url + token for token in tokens]
+    return tokens
+
+@defer.inlineCallbacks
+def run(options):
+    pem = fake.make_certificate()
+    gateway, feedback, c2dm, ports = fake.listen(pem, options.feedback)
+    site = reactor.listenTCP(0, server.Site(PNSServer()), interface='127.0.0.1')
+    proxy = xmlrpc.Proxy('http://127.0.0.1:%d/' % site.getHost().port,
+                         allowNone=True)
+    provision(options.provider, pem, ports, options.pool_size)
+
+    tokens = make_tokens(options.provider, ports, options.batch)
+    notification = {'aps': {'alert': 'benchmark', 'badge': 1}}
+    if options.provider == 'wns':
+        notification = {'content': '<toast><visual><binding template="ToastText01">'
+                                   '<text id="1">benchmark</text></binding></visual></toast>'}
+    notifications = [notification] * options.batch
+    calls = options.notifications // options.batch
+    latencies = []
+
+    def notify():
+        started = time.time()
+        d = proxy.callRemote('notify', APP_ID, options.provider,
+                             tokens, notifications)
+        return d.addCallback(lambda r: latencies.append(time.time() - started))
+
+    # one warm up call pays for the connection and TLS handshake
+    yield notify()
+    del latencies[:]
+    received = gateway.received
+
+    semaphore = defer.DeferredSemaphore(options.concurrency)
+    started = time.time()
+    yield defer.gatherResults([semaphore.run(notify) for _ in xrange(calls)])
+    if options.provider == 'apns':
+        yield gateway.expect(received + calls * options.batch - gateway.received)
+    elapsed = time.time() - started
+
+    latencies.sort()
+    sent = calls * options.batch
+    print 'provider          %s' % options.provider
+    print 'notifications     %d in %d calls of %d' % (sent, calls, options.batch)
+    print 'elapsed           %.3fs' % elapsed
+    print 'notifications/sec %.0f' % (sent / elapsed)
+    print 'notify p50        %.1fms' % (percentile(latencies, 0.5) * 1000)
+    print 'notify p99        %.1fms' % (percentile(latencies, 0.99) * 1000)
+
+    if options.provider == 'apns' and options.feedback:
+        started = time.time()
+        records = yield proxy.callRemote('feedback', APP_ID, 'apns')
+        print 'feedback          %d records in %.3fs' % (
+            len(records), time.time() - started)
+
+    print 'peak RSS          %.1fMB' % peak_rss()
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option('--provider', default='apns', choices=['apns', 'c2dm', 'wns'])
+    parser.add_option('--notifications', type='int', default=100000)
+    parser.add_option('--batch', type='int', default=1000,
+                      help='notifications per notify call')
+    parser.add_option('--concurrency', type='int', default=8,
+                      help='notify calls in flight')
+    parser.add_option('--pool-size', type='int', default=1,
+                      help='gateway connections of the APNS service')
+    parser.add_option('--feedback', type='int', default=10000,
+                      help='records served by the fake feedback service')
+    parser.add_option('--verbose', action='store_true',
+                      help='log to stderr')
+    options, args = parser.parse_args()
+    if options.verbose:
+        log.startLogging(sys.stderr)
+
+    def done(r):
+        reactor.stop()
+        return r
+    reactor.callWhenRunning(
+        lambda: run(options).addErrback(log.err).addBoth(done))
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+""" Local stand-ins for the APNS gateway, the APNS feedback service, the
+C2DM endpoint and WNS, so pypns can be measured without talking to Apple,
+Google or Microsoft.
+"""
+
+import os
+import json
+import time
+import struct
+import itertools
+from OpenSSL import crypto
+from twisted.internet import reactor, defer, ssl
+from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.web import resource, server
+
+NOTIFICATION_HEADERS = {
+    0: struct.Struct('!BH'),      # command, token length
+    1: struct.Struct('!BIIH'),    # command, identifier, expiry, token length
+}
+FRAME_HEADER = struct.Struct('!BI')
+ITEM_HEADER = struct.Struct('!BH')
+LENGTH = struct.Struct('!H')
+FEEDBACK_RECORD = struct.Struct('!IH32s')
+
+def make_certificate(common_name='pypns-benchmark'):
+    "A self signed certificate and its key as a single PEM string"
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = common_name
+    cert.set_serial_number(int(time.time()))
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return (crypto.dump_certificate(crypto.FILETYPE_PEM, cert) +
+            crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+def server_context(pem):
+    "A server side TLS context factory for the PEM of `make_certificate`"
+    return ssl.CertificateOptions(
+        privateKey=crypto.load_privatekey(crypto.FILETYPE_PEM, pem),
+        certificate=crypto.load_certificate(crypto.FILETYPE_PEM, pem))
+
+def parse_notification(data, offset=0):
+    """ Returns the (identifier, token, payload) of the notification at
+    `offset` and the offset of the next one, or None when `data` doesn't
+    hold a whole notification yet """
+    if len(data) - offset < 1:
+        return None
+    command = ord(data[offset])
+    if command in NOTIFICATION_HEADERS:
+        header = NOTIFICATION_HEADERS[command]
+        if len(data) - offset < header.size:
+            return None
+        fields = header.unpack_from(data, offset)
+        identifier = fields[1] if command == 1 else 0
+        start = offset + header.size
+        end = start + fields[-1] + LENGTH.size
+        if len(data) < end:
+            return None
+        token = data[start:start + fields[-1]]
+        length = LENGTH.unpack_from(data, end - LENGTH.size)[0]
+        if len(data) < end + length:
+            return None
+        return (identifier, token, data[end:end + length]), end + length
+    if command == 2:
+        if len(data) - offset < FRAME_HEADER.size:
+            return None
+        length = FRAME_HEADER.unpack_from(data, offset)[1]
+        start = offset + FRAME_HEADER.size
+        if len(data) < start + length:
+            return None
+        items = {}
+        position = start
+        while position < start + length:
+            item, size = ITEM_HEADER.unpack_from(data, position)
+            position += ITEM_HEADER.size
+            items[item] = data[position:position + size]
+            position += size
+        identifier = struct.unpack('!I', items.get(3, '\0' * 4))[0]
+        return (identifier, items.get(1), items.get(2)), start + length
+    raise ValueError('Unknown APNS command %d' % command)
+
+
+class GatewayProtocol(Protocol):
+    def connectionMade(self):
+        self.buffer = ''
+        self.factory.connections += 1
+
+    def dataReceived(self, data):
+        self.buffer += data
+        offset = 0
+        received = []
+        while True:
+            parsed = parse_notification(self.buffer, offset)
+            if parsed is None:
+                break
+            notification, offset = parsed
+            received.append(notification)
+        self.buffer = self.buffer[offset:]
+        if received:
+            self.factory.notificationsReceived(self, received)
+
+    def connectionLost(self, reason):
+        self.factory.connections -= 1
+
+
+class FakeGateway(ServerFactory):
+    """ Accepts APNS connections and counts the notifications written to
+    it. `expect(n)` returns a Deferred firing once `n` more arrived. """
+
+    protocol = GatewayProtocol
+
+    def __init__(self):
+        self.received = 0
+        self.connections = 0
+        self.waiters = []
+
+    def notificationsReceived(self, protocol, notifications):
+        self.received += len(notifications)
+        while self.waiters and self.waiters[0][0] <= self.received:
+            self.waiters.pop(0)[1].callback(self.received)
+
+    def expect(self, count):
+        d = defer.Deferred()
+        if count <= 0:
+            d.callback(self.received)
+        else:
+            self.waiters.append((self.received + count, d))
+            self.waiters.sort(key=lambda w: w[0])
+        return d
+
+
+class FeedbackProtocol(Protocol):
+    def connectionMade(self):
+        self.transport.write(self.factory.records)
+        self.transport.loseConnection()
+
+
+class FakeFeedback(ServerFactory):
+    "Writes `count` random feedback records to every connection"
+
+    protocol = FeedbackProtocol
+
+    def __init__(self, count=1000):
+        self.records = encode_feedback(count)
+
+
+class FakeC2DM(resource.Resource):
+    """ Answers the ClientLogin request with a token and every send with a
+    message id, just enough for C2DMService. Every `quota_every` sends one
+    is answered with QuotaExceeded.
+
+        POST /login
+        POST /send
+    """
+
+    isLeaf = True
+
+    def __init__(self, quota_every=0):
+        resource.Resource.__init__(self)
+        self.received = 0
+        self.quota_every = quota_every
+        self.requests = 0
+        self.rejected = 0
+        self.ids = itertools.count(1)
+
+    def render_POST(self, request):
+        request.setHeader('Content-Type', 'text/plain')
+        if request.postpath == ['login']:
+            return 'SID=sid\nLSID=lsid\nAuth=benchmark-token\n'
+        if request.postpath == ['send']:
+            self.requests += 1
+            if self.quota_every and self.requests % self.quota_every == 0:
+                self.rejected += 1
+                return 'Error=QuotaExceeded\n'
+            self.received += 1
+            return 'id=%d\n' % next(self.ids)
+        request.setResponseCode(404)
+        return ''
+
+
+class FakeWNS(resource.Resource):
+    """ Answers the access token request and every push to a channel, the
+    channels whose id starts with 'expired' are gone.
+
+        POST /token
+        POST /channel/<id>
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.received = 0
+        self.tokens = 0
+
+    def render_POST(self, request):
+        if request.postpath == ['token']:
+            self.tokens += 1
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({'access_token': 'benchmark-token',
+                               'token_type': 'bearer', 'expires_in': 86400})
+        if len(request.postpath) == 2 and request.postpath[0] == 'channel':
+            if request.postpath[1].startswith('expired'):
+                request.setResponseCode(410)
+                return ''
+            self.received += 1
+            request.setHeader('X-WNS-Status', 'received')
+            return ''
+        request.setResponseCode(404)
+        return ''
+
+
+def encode_feedback(count):
+    "`count` packed feedback records of random tokens"
+    now = int(time.time())
+    return ''.join(FEEDBACK_RECORD.pack(now, 32, os.urandom(32))
+                   for _ in xrange(count))
+
+def listen(pem, feedback_records=1000, interface='127.0.0.1'):
+    """ Starts the fake gateway, feedback service, C2DM endpoint and WNS on
+    free ports, returns the first three and every listening port. The
+    FakeWNS is the resource of the site of the 'wns' port. """
+    context = server_context(pem)
+    gateway = FakeGateway()
+    feedback = FakeFeedback(feedback_records)
+    c2dm = FakeC2DM()
+    ports = {
+        'gateway': reactor.listenSSL(0, gateway, context, interface=interface),
+        'feedback': reactor.listenSSL(0, feedback, context, interface=interface),
+        'c2dm': reactor.listenTCP(0, server.Site(c2dm), interface=interface),
+        'wns': reactor.listenTCP(0, server.Site(FakeWNS()), interface=interface),
+    }
+    return gateway, feedback, c2dm, ports
@@ -0,0 +1,138 @@
+""" Sends notifications through APNSService to the fault-injecting gateway
+and reports how long outages stall delivery and what is lost or duplicated
+
+    python -m benchmarks.recovery [--scenario all] [--notifications 20000]
+        [--reconnect-delay 1.0] [--max-reconnect-delay 3600]
+        [--backoff-factor 2.718] [--resend-buffer 10000] [--rate 0]
+"""
+
+import os
+import sys
+import time
+import struct
+import binascii
+import optparse
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+from pypns.apns.client import (
+    APNSService, RECONNECT_DELAY, MAX_RECONNECT_DELAY, BACKOFF_FACTOR,
+    RESEND_BUFFER_SIZE)
+from benchmarks import fake, simulator
+from benchmarks.end_to_end import percentile
+
+SCENARIOS = {
+    'disconnect': {'disconnect_every': 2500},
+    'reject': {'reject_every': 2000},
+    'slow': {'read_delay': 0.01},
+    'handshake': {'handshake_delay': 2, 'disconnect_every': 5000},
+}
+
+def make_tokens(count):
+    "Binary tokens starting with their sequence number"
+    return [struct.pack('!Q', i) + os.urandom(24) for i in xrange(count)]
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+@defer.inlineCallbacks
+def run_scenario(name, faults, pem, options):
+    tokens = make_tokens(options.notifications)
+    reject_every = faults.pop('reject_every', 0)
+    if reject_every:
+        faults['reject'] = tokens[reject_every - 1::reject_every]
+    gateway, port = simulator.listen(pem, **faults)
+    service = APNSService(
+        pem, 'sandbox', gateway_address=('127.0.0.1', port.getHost().port),
+        resend_buffer=options.resend_buffer,
+        reconnect_delay=options.reconnect_delay,
+        max_reconnect_delay=options.max_reconnect_delay,
+        backoff_factor=options.backoff_factor, idle_timeout=0,
+        rate=options.rate)
+    notification = {'aps': {'alert': 'recovery'}}
+    expected = len(tokens) - len(gateway.reject)
+
+    started = time.time()
+    for i in xrange(0, len(tokens), options.batch):
+        batch = [binascii.hexlify(t) for t in tokens[i:i + options.batch]]
+        service.notify(batch, notification).addErrback(lambda err: None)
+        yield sleep(options.interval)
+
+    # wait until everything arrived or nothing did for `quiet` seconds
+    while len(gateway.tokens) < expected:
+        last = gateway.last_received or started
+        if time.time() - last > options.quiet:
+            break
+        yield sleep(0.1)
+    elapsed = (gateway.last_received or time.time()) - started
+
+    for factory in service.factories:
+        factory.stopTrying()
+        factory.connector.disconnect()
+    yield port.stopListening()
+
+    received = set(gateway.tokens)
+    lost = len([t for t in tokens if t not in received and t not in gateway.reject])
+    duplicated = sum(count - 1 for count in gateway.tokens.itervalues())
+    recoveries = sorted(gateway.recoveries)
+    print '%-10s %8d %8d %8d %8d %7d %8.3f %8.3f %8.3f' % (
+        name, len(tokens), len(received), lost, duplicated, len(gateway.faults),
+        percentile(recoveries, 0.5), recoveries[-1] if recoveries else 0,
+        elapsed)
+
+@defer.inlineCallbacks
+def run(options):
+    pem = fake.make_certificate()
+    names = sorted(SCENARIOS) if options.scenario == 'all' else [options.scenario]
+    print '%-10s %8s %8s %8s %8s %7s %8s %8s %8s' % (
+        'scenario', 'sent', 'received', 'lost', 'dup', 'faults',
+        'rec p50', 'rec max', 'elapsed')
+    for name in names:
+        faults = dict(SCENARIOS[name])
+        for key in ('disconnect_every', 'reject_every', 'read_delay',
+                    'handshake_delay'):
+            value = getattr(options, key)
+            if value is not None:
+                faults[key] = value
+        yield run_scenario(name, faults, pem, options)
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option('--scenario', default='all',
+                      choices=['all'] + sorted(SCENARIOS))
+    parser.add_option('--notifications', type='int', default=20000)
+    parser.add_option('--batch', type='int', default=500,
+                      help='notifications per notify call')
+    parser.add_option('--interval', type='float', default=0.02,
+                      help='seconds between notify calls')
+    parser.add_option('--quiet', type='float', default=10,
+                      help='give up after that many seconds without progress')
+    parser.add_option('--disconnect-every', type='int',
+                      help='drop the connection every that many notifications')
+    parser.add_option('--reject-every', type='int',
+                      help='reject every that many tokens as invalid')
+    parser.add_option('--read-delay', type='float',
+                      help='seconds the gateway stops reading after every read')
+    parser.add_option('--handshake-delay', type='float',
+                      help='seconds before the gateway starts the TLS handshake')
+    parser.add_option('--reconnect-delay', type='float', default=RECONNECT_DELAY)
+    parser.add_option('--max-reconnect-delay', type='float',
+                      default=MAX_RECONNECT_DELAY)
+    parser.add_option('--backoff-factor', type='float', default=BACKOFF_FACTOR)
+    parser.add_option('--resend-buffer', type='int', default=RESEND_BUFFER_SIZE)
+    parser.add_option('--rate', type='float', default=0,
+                      help='notifications/s to pace to, unpaced by default')
+    parser.add_option('--verbose', action='store_true',
+                      help='log to stderr')
+    options, args = parser.parse_args()
+    if options.verbose:
+        log.startLogging(sys.stderr)
+
+    def done(r):
+        reactor.stop()
+        return r
+    reactor.callWhenRunning(
+        lambda: run(options).addErrback(log.err).addBoth(done))
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
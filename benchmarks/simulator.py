@@ -0,0 +1,119 @@
+""" A fake APNS gateway injecting faults on demand: mid-stream disconnects,
+error responses for chosen tokens, slow reads and TLS handshake delays.
+"""
+
+import time
+import struct
+import collections
+from twisted.internet import reactor
+from benchmarks.fake import FakeGateway, GatewayProtocol, server_context
+
+ERROR_RESPONSE = struct.Struct('!BBI')
+STATUS_INVALID_TOKEN = 8
+
+
+class FaultyGatewayProtocol(GatewayProtocol):
+    def connectionMade(self):
+        GatewayProtocol.connectionMade(self)
+        self.faulted = False
+        # the handshake only starts once TLS is negotiated after the delay
+        self.transport.pauseProducing()
+        reactor.callLater(self.factory.handshake_delay, self.startTLS)
+
+    def startTLS(self):
+        if self.transport.connected:
+            self.transport.startTLS(self.factory.context)
+            self.transport.resumeProducing()
+
+    def dataReceived(self, data):
+        if self.faulted:
+            return
+        GatewayProtocol.dataReceived(self, data)
+        if self.factory.read_delay and not self.faulted:
+            self.transport.pauseProducing()
+            reactor.callLater(self.factory.read_delay, self.resumeReading)
+
+    def resumeReading(self):
+        if self.transport.connected and not self.faulted:
+            self.transport.resumeProducing()
+
+    def reject(self, identifier, status=STATUS_INVALID_TOKEN):
+        "Answer with an error response and close, like APNS does"
+        self.faulted = True
+        self.transport.write(ERROR_RESPONSE.pack(8, status, identifier))
+        self.transport.loseConnection()
+
+    def disconnect(self):
+        "Drop the connection without a word, losing whatever is in flight"
+        self.faulted = True
+        self.transport.abortConnection()
+
+
+class FaultyGateway(FakeGateway):
+    """ Counts every token received and injects faults:
+
+          reject             binary tokens answered with an error response
+          disconnect_every   drop the connection every that many notifications
+          read_delay         seconds to stop reading after every read
+          handshake_delay    seconds before the TLS handshake starts
+
+    `faults` holds the time of every fault and `recoveries` the seconds it
+    took for the next notification to arrive after the first fault of each
+    outage. """
+
+    protocol = FaultyGatewayProtocol
+
+    def __init__(self, context, reject=(), disconnect_every=0, read_delay=0,
+                 handshake_delay=0):
+        FakeGateway.__init__(self)
+        self.context = context
+        self.reject = set(reject)
+        self.disconnect_every = disconnect_every
+        self.read_delay = read_delay
+        self.handshake_delay = handshake_delay
+        self.tokens = collections.Counter()
+        self.faults = []
+        self.recoveries = []
+        self.rejected = 0
+        self.fault_at = None
+        self.last_received = None
+
+    def notificationsReceived(self, protocol, notifications):
+        accepted = []
+        for identifier, token, payload in notifications:
+            if token in self.reject:
+                self.rejected += 1
+                self.fault()
+                protocol.reject(identifier)
+                break
+            accepted.append(token)
+            self.recovered()
+            if (self.disconnect_every and
+                    (self.received + len(accepted)) % self.disconnect_every == 0):
+                self.fault()
+                protocol.disconnect()
+                break
+        if accepted:
+            self.last_received = time.time()
+            self.tokens.update(accepted)
+            FakeGateway.notificationsReceived(self, protocol, accepted)
+
+    def recovered(self):
+        "A notification made it through after the last fault"
+        if self.fault_at is not None:
+            self.recoveries.append(time.time() - self.fault_at)
+            self.fault_at = None
+
+    def fault(self):
+        now = time.time()
+        self.faults.append(now)
+        if self.fault_at is None:
+            self.fault_at = now
+
+
+def listen(pem, interface='127.0.0.1', **faults):
+    """ Starts a FaultyGateway on a free port, the TLS handshake is done by
+    the protocol so it can be delayed """
+    gateway = FaultyGateway(server_context(pem), **faults)
+    port = reactor.listenTCP(0, gateway, interface=interface)
+    return gateway, port
@@ -1 +1 @@
-from base import register_factoryfrom apns.client import APNSServicefrom c2dm.client import C2DMServicedef apns_factory(**kwargs):    return APNSService(**kwargs)def c2dm_factory(**kwargs):    return C2DMService(**kwargs)register_factory('apns', apns_factory)register_factory('c2dm', c2dm_factory)
\ No newline at end of file
+from base import register_factoryfrom apns.client import APNSServicefrom c2dm.client import C2DMServicefrom wns.client import WNSServicedef apns_factory(**kwargs):    return APNSService(**kwargs)def c2dm_factory(**kwargs):    return C2DMService(**kwargs)def wns_factory(**kwargs):    return WNSService(**kwargs)register_factory('apns', apns_factory)register_factory('c2dm', c2dm_factory)register_factory('wns', wns_factory)
\ No newline at end of file
@@ -1,17 +1,30 @@
+import os
 import json
 import struct
+import hashlib
+import weakref
 import binascii
+import datetime
+import time
+import tempfile
+import itertools
+import collections
 from twisted.python import log
-from StringIO import StringIO as _StringIO
 from OpenSSL import SSL, crypto
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
+from twisted.internet.interfaces import (
+    IPushProducer, IOpenSSLClientConnectionCreator)
 from twisted.internet.protocol import (
     ReconnectingClientFactory, ClientFactory, Protocol)
 from twisted.internet.ssl import ClientContextFactory
 from twisted.application import service
-from twisted.protocols.basic import LineReceiver
 from zope.interface import Interface, implements
+from pypns import base
 from pypns.base import IPNSService
+from pypns.inactive import InactiveTokens
+from pypns.pacing import TokenBucket
+from pypns.spool import Spool
+from pypns.stats import Metrics
 
 APNS_SERVER_SANDBOX_HOSTNAME = "gateway.sandbox.push.apple.com"
 APNS_SERVER_HOSTNAME = "gateway.push.apple.com"
@@ -20,26 +33,89 @@ FEEDBACK_SERVER_SANDBOX_HOSTNAME = "feedback.sandbox.push.apple.com"
 FEEDBACK_SERVER_HOSTNAME = "feedback.push.apple.com"
 FEEDBACK_SERVER_PORT = 2196
 
-class StringIO(_StringIO):
-    """Add context management protocol to StringIO
-        ie: http://bugs.python.org/issue1286
-    """
+COMMAND_SIMPLE = 0
+COMMAND_ENHANCED = 1
+COMMAND_FRAME = 2
+COMMAND_ERROR_RESPONSE = 8
+
+ERROR_RESPONSE = struct.Struct('!BBI')
+ERROR_STATUS_INVALID_TOKEN = 8
+ERROR_STATUS_SHUTDOWN = 10
+# statuses blaming the notification rather than how fast it was sent
+ERROR_STATUS_NOTIFICATION = (2, 3, 4, 5, 6, 7, 8)
+ERROR_STATUS = {
+    0: 'No errors encountered',
+    1: 'Processing error',
+    2: 'Missing device token',
+    3: 'Missing topic',
+    4: 'Missing payload',
+    5: 'Invalid token size',
+    6: 'Invalid topic size',
+    7: 'Invalid payload size',
+    8: 'Invalid token',
+    10: 'Shutdown',
+    255: 'None (unknown)',
+}
+
+RESEND_BUFFER_SIZE = 10000
+WRITE_CHUNK_SIZE = 256
+MAX_PENDING = 100000
+TOKEN_CHUNK_SIZE = 1024
+PAYLOAD_CACHE_SIZE = 64
+# json.dumps builds an encoder on every call given separators
+JSON_ENCODER = json.JSONEncoder(separators=(',',':'))
+
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_SPILL = 'spill'
+
+PRIORITY_HIGH = 'high'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_BULK = 'bulk'
+# chunks every lane writes in turn while the others have streams too
+LANE_WEIGHTS = ((PRIORITY_HIGH, 16), (PRIORITY_NORMAL, 4), (PRIORITY_BULK, 1))
+LANES = [lane for lane, weight in LANE_WEIGHTS]
 
-    def __enter__(self):
-        if self.closed:
-            raise ValueError('I/O operation on closed file')
-        return self
+SPILL_RECORD = struct.Struct('!IHI')
+FEEDBACK_RECORD = struct.Struct('!IH32s')
+FEEDBACK_BATCH_SIZE = 1000
 
-    def __exit__(self, exc, value, tb):
-        self.close()
+IDLE_TIMEOUT = 300
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 3600
+BACKOFF_FACTOR = 2.7182818284590451
+# shortest wait for the pacer, so every wake up writes a few notifications
+MIN_PACE_DELAY = 0.01
+# seconds a connection must stay up without an error after writing spooled
+# notifications still in its resend window before they are acked
+SPOOL_SETTLE_DELAY = 5
+
+# negotiate the best protocol both ends support, TLS 1.1 at the very least
+SSL_METHOD = SSL.SSLv23_METHOD
+SSL_OPTIONS = SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3 | SSL.OP_NO_TLSv1
+
+# APNSClientContextFactory by fingerprint of the PEM, shared by every
+# service using the same certificate while any of them is alive
+context_factories = weakref.WeakValueDictionary()
+
+class PendingQueueFullException(Exception):
+    pass
 
 class APNSClientContextFactory(ClientContextFactory):
+    """ The SSL context of a certificate. It remembers the last TLS session
+    negotiated with every (host, port) and resumes it on reconnect, which
+    spares the full handshake. """
+
+    implements(IOpenSSLClientConnectionCreator)
+
     def __init__(self, ssl_cert_file):
         if 'BEGIN CERTIFICATE' not in ssl_cert_file:
             log.msg('APNSClientContextFactory ssl_cert_file=%s' % ssl_cert_file)
         else:
             log.msg('APNSClientContextFactory ssl_cert_file={FROM_STRING}')
-        self.ctx = SSL.Context(SSL.SSLv3_METHOD)
+        self.ctx = SSL.Context(SSL_METHOD)
+        self.ctx.set_options(SSL_OPTIONS)
+        self.ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
         if 'BEGIN CERTIFICATE' in ssl_cert_file:
             cer = crypto.load_certificate(crypto.FILETYPE_PEM, ssl_cert_file)
             pkey = crypto.load_privatekey(crypto.FILETYPE_PEM, ssl_cert_file)
@@ -48,59 +124,357 @@ class APNSClientContextFactory(ClientContextFactory):
         else:
             self.ctx.use_certificate_file(ssl_cert_file)
             self.ctx.use_privatekey_file(ssl_cert_file)
+        # the last connection to every (host, port), its session is only
+        # complete once TLS 1.3 tickets arrived after the handshake
+        self.connections = {}
 
     def getContext(self):
         return self.ctx
 
+    def clientConnectionForTLS(self, tlsProtocol):
+        return self.connection()
+
+    def connection(self, address=None):
+        "A client connection resuming the last session with `address`"
+        connection = SSL.Connection(self.ctx, None)
+        if address is None:
+            return connection
+        previous = self.connections.get(address)
+        session = previous.get_session() if previous is not None else None
+        if session is not None:
+            connection.set_session(session)
+        self.connections[address] = connection
+        return connection
+
+
+class APNSConnectionCreator(object):
+    """ Connects to the APNS endpoint `address` with the certificate of
+    `service` at the time, so reconnects pick up a reloaded one """
+
+    implements(IOpenSSLClientConnectionCreator)
+
+    def __init__(self, service, address):
+        self.service = service
+        self.address = address
+
+    def getContext(self):
+        return self.service.current_context().getContext()
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        return self.service.current_context().connection(self.address)
+
+
+def read_certificate(cert):
+    """ Returns the PEM of `cert`, a path or the PEM itself, and the mtime of
+    the file """
+    if 'BEGIN CERTIFICATE' in cert:
+        return cert, None
+    with open(cert, 'rb') as f:
+        return f.read(), os.fstat(f.fileno()).st_mtime
+
+def get_context_factory(pem, factory=None):
+    """ The shared APNSClientContextFactory of the certificate `pem`,
+    `factory` if there is none yet """
+    fingerprint = hashlib.sha1(pem).hexdigest()
+    cached = context_factories.get(fingerprint)
+    if cached is None:
+        cached = context_factories[fingerprint] = (
+            factory or APNSClientContextFactory(pem))
+    return cached
+
+def load_certificate(cert):
+    """ Returns the PEM, mtime and a new APNSClientContextFactory of `cert`,
+    thread safe """
+    pem, mtime = read_certificate(cert)
+    return pem, mtime, APNSClientContextFactory(pem)
+
+
+class NotificationStream(object):
+    """ A lazily encoded batch of (identifier, token, frame) notifications
+    shared by every connection of the pool, so each one pulls chunks of
+    it as fast as its socket drains.
+    """
+
+    def __init__(self, notifications, priority=PRIORITY_NORMAL):
+        if priority not in LANES:
+            raise ValueError('Unknown priority %r' % priority)
+        self.notifications = iter(notifications)
+        self.deferred = defer.Deferred()
+        self.priority = priority
+        self.created = time.time()
+        self.started = None
+
+    @property
+    def done(self):
+        return self.deferred.called
+
+    def next_chunk(self, size):
+        try:
+            chunk = list(itertools.islice(self.notifications, size))
+        except Exception, e:
+            log.msg('NotificationStream encoding error: %s' % str(e))
+            self.fail(e)
+            return []
+        if len(chunk) < size and not self.done:
+            self.deferred.callback(None)
+        return chunk
+
+    def fail(self, err):
+        if not self.done:
+            self.deferred.errback(err)
+
+
+class SpooledStream(NotificationStream):
+    """ A NotificationStream of the (start, end) range of the spool. Every
+    chunk it hands out covers the spool range from `chunk_start` to the
+    last of `ends`, the offsets right after the record of each frame.
+    Connections ack those ranges once the frames can no longer be lost.
+    """
+
+    def __init__(self, service, start, end, count, priority=PRIORITY_NORMAL):
+        self.spool = service.spool
+        self.start = self.position = self.handed = start
+        self.end = end
+        self.count = count
+        self.taken = 0
+        self.chunk_start = start
+        self.ends = []
+        self.failed = False
+        NotificationStream.__init__(self, self.frames(
+            service.encode_spooled(self.track(self.spool.records(start, end)))),
+            priority)
+
+    def track(self, records):
+        for position, token, payload, expiry in records:
+            self.position = position
+            yield token, payload, expiry
+
+    def frames(self, notifications):
+        for notification in notifications:
+            self.ends.append(self.position)
+            yield notification
+
+    def next_chunk(self, size):
+        self.chunk_start = self.position
+        self.ends = []
+        chunk = NotificationStream.next_chunk(self, size)
+        if self.failed:
+            return []
+        if not chunk and self.position != self.chunk_start:
+            # nothing but suppressed tokens, there is nothing to lose
+            self.spool.ack(self.chunk_start, self.position)
+        elif chunk and self.done and self.ends[-1] != self.position:
+            # the last chunk also covers the suppressed tokens after it
+            self.ends[-1] = self.position
+        self.handed = self.position
+        self.taken += len(chunk)
+        return chunk
+
+    def fail(self, err):
+        if not self.done:
+            self.failed = True
+        NotificationStream.fail(self, err)
+
 
 class APNSProtocol(Protocol):
+    """ Writes NotificationStreams as a push producer: it is paused by the
+    transport whenever the send buffer is full and resumed once it drains.
+
+    Streams wait in one lane per priority, and the lanes take turns
+    writing chunks following `schedule`, so urgent notifications don't
+    wait behind a large broadcast. Writing also stops while the token
+    buckets of the service or the connection run dry.
+    """
+
+    implements(IPushProducer)
+    chunk_size = WRITE_CHUNK_SIZE
+    schedule = [lane for lane, weight in LANE_WEIGHTS for _ in xrange(weight)]
+
     def connectionMade(self):
         log.msg('APNSProtocol connectionMade')
+        self._buffer = ''
+        self.lanes = dict((lane, collections.deque()) for lane in LANES)
+        self.turn = 0
+        self.paused = False
+        self.producing = False
+        self.pace_call = None
+        self.transport.registerProducer(self, True)
         self.factory.addClient(self)
 
-    def sendMessage(self, msg):
-        log.msg('APNSProtocol sendMessage msg=%s' % binascii.hexlify(msg))
-        self.transport.write(msg)
+    def sendStream(self, stream):
+        self.lanes[stream.priority].append(stream)
+        if not self.paused:
+            self.resumeProducing()
+        return stream.deferred
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.producing:
+            # write() can pause and resume us synchronously
+            return
+        self.producing = True
+        try:
+            while not self.paused:
+                size = self.factory.allowance(self.chunk_size)
+                if not size:
+                    if any(self.lanes.itervalues()):
+                        self.pace()
+                    break
+                stream = self.nextStream()
+                if stream is None:
+                    break
+                chunk = stream.next_chunk(size)
+                if chunk:
+                    self.factory.consume(len(chunk))
+                    metrics = self.factory.metrics
+                    if stream.started is None:
+                        stream.started = time.time()
+                        metrics.observe('queue_seconds',
+                                        stream.started - stream.created,
+                                        lane=stream.priority)
+                    self.factory.framesWritten(stream, chunk)
+                    data = ''.join([frame for _, _, frame in chunk])
+                    self.transport.write(data)
+                    metrics.incr('notifications_sent', len(chunk))
+                    metrics.incr('bytes_sent', len(data))
+        finally:
+            self.producing = False
+
+    def nextStream(self):
+        "The stream of the next lane in the schedule with anything to write"
+        for _ in xrange(len(self.schedule)):
+            streams = self.lanes[self.schedule[self.turn]]
+            self.turn = (self.turn + 1) % len(self.schedule)
+            while streams and streams[0].done:
+                streams.popleft()
+            if streams:
+                return streams[0]
+        return None
+
+    def pace(self):
+        "Stop writing until the token buckets let more notifications through"
+        if self.pace_call is None:
+            self.factory.metrics.incr('pacing_waits')
+            self.pace_call = reactor.callLater(
+                max(MIN_PACE_DELAY, self.factory.pacingDelay()), self.paced)
+
+    def paced(self):
+        self.pace_call = None
+        if not self.paused:
+            self.resumeProducing()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def stopProducing(self):
+        self.paused = True
+        for streams in self.lanes.itervalues():
+            streams.clear()
+
+    def dataReceived(self, data):
+        # APNS only ever writes a 6 byte error response right before it
+        # closes the connection, but be careful with partial reads anyway
+        self._buffer += data
+        while len(self._buffer) >= ERROR_RESPONSE.size:
+            command, status, identifier = ERROR_RESPONSE.unpack_from(self._buffer)
+            self._buffer = self._buffer[ERROR_RESPONSE.size:]
+            if command == COMMAND_ERROR_RESPONSE:
+                self.factory.errorReceived(self, status, identifier)
+                # the transport never closes while a producer is registered
+                self.stopProducing()
+                self.transport.unregisterProducer()
+                self.transport.loseConnection()
+            else:
+                log.msg('APNSProtocol unexpected command %d' % command)
 
     def connectionLost(self, reason):
         log.msg('APNSProtocol connectionLost')
+        for streams in self.lanes.itervalues():
+            streams.clear()
+        if self.pace_call is not None:
+            self.pace_call.cancel()
+            self.pace_call = None
         self.factory.removeClient(self)
 
 
-class APNSFeedbackHandler(LineReceiver):
-    MAX_LENGTH = 1024*1024
+class FeedbackDecoder(object):
+    """ Decodes (datetime, token_str) feedback tuples from arbitrary chunks
+    of the feedback stream, carrying partial records over to the next one.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, data):
+        "Returns the records completed by `data`"
+        if self.buffer:
+            data = self.buffer + data
+        end = len(data) - len(data) % FEEDBACK_RECORD.size
+        self.buffer = data[end:]
+        fromtimestamp, hexlify = datetime.datetime.fromtimestamp, binascii.hexlify
+        return [(fromtimestamp(ts), hexlify(token))
+                for ts, _, token in (FEEDBACK_RECORD.unpack_from(data, offset)
+                                     for offset in xrange(0, end, FEEDBACK_RECORD.size))]
 
+
+class APNSFeedbackHandler(Protocol):
     def connectionMade(self):
         log.msg('feedbackHandler connectionMade')
+        self.decoder = FeedbackDecoder()
 
-    def rawDataReceived(self, data):
-        log.msg('feedbackHandler rawDataReceived %s' % binascii.hexlify(data))
-        self.io.write(data)
-
-    def lineReceived(self, data):
-        log.msg('feedbackHandler lineReceived %s' % binascii.hexlify(data))
-        self.io.write(data)
+    def dataReceived(self, data):
+        records = self.decoder.feed(data)
+        if records:
+            self.factory.recordsReceived(records)
 
     def connectionLost(self, reason):
         log.msg('feedbackHandler connectionLost %s' % reason)
-        self.deferred.callback(self.io.getvalue())
-        self.io.close()
+        self.factory.finished()
 
 
 class APNSFeedbackClientFactory(ClientFactory):
+    """ Collects the feedback records, or hands them to `consumer` in
+    batches of `batch_size` to keep memory bounded. The deferred fires with
+    the list of records, or with their count when there is a consumer.
+    """
+
     protocol = APNSFeedbackHandler
 
-    def __init__(self):
+    def __init__(self, consumer=None, batch_size=FEEDBACK_BATCH_SIZE,
+                 metrics=None):
         self.deferred = defer.Deferred()
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.metrics = metrics or Metrics('apns')
+        self.records = []
+        self.count = 0
 
     def buildProtocol(self, addr):
         p = self.protocol()
         p.factory = self
-        p.deferred = self.deferred
-        p.io = StringIO()
-        p.setRawMode()
         return p
 
+    def recordsReceived(self, records):
+        self.records.extend(records)
+        self.count += len(records)
+        if self.consumer is not None:
+            while len(self.records) >= self.batch_size:
+                batch = self.records[:self.batch_size]
+                del self.records[:self.batch_size]
+                self.consumer(batch)
+
+    def finished(self):
+        if self.deferred.called:
+            return
+        self.metrics.observe('feedback_records', self.count)
+        if self.consumer is None:
+            self.deferred.callback(self.records)
+        else:
+            if self.records:
+                self.consumer(self.records)
+                self.records = []
+            self.deferred.callback(self.count)
+
     def startedConnecting(self, connector):
         log.msg('APNSFeedbackClientFactory startedConnecting')
 
@@ -116,15 +490,51 @@ class APNSFeedbackClientFactory(ClientFactory):
 class APNSClientFactory(ReconnectingClientFactory):
     protocol = APNSProtocol
 
-    def __init__(self):
+    def __init__(self, service=None, resend_buffer=RESEND_BUFFER_SIZE,
+                 reconnect_delay=RECONNECT_DELAY,
+                 max_reconnect_delay=MAX_RECONNECT_DELAY,
+                 backoff_factor=BACKOFF_FACTOR, rate=None, burst=None):
+        self.service = service
+        # every retry waits backoff_factor times longer than the previous
+        # one, starting from reconnect_delay and up to max_reconnect_delay
+        self.initialDelay = self.delay = reconnect_delay
+        self.maxDelay = max_reconnect_delay
+        self.factor = backoff_factor
         self.clientProtocol = None
         self.deferred = defer.Deferred()
         self.deferred.addErrback(log_errback('APNSClientFactory __init__'))
+        # (identifier, token, frame) of the most recently written frames,
+        # so whatever APNS dropped after a failed notification can be resent
+        self.sent = collections.deque(maxlen=resend_buffer)
+        self.failed_identifier = None
+        self.metrics = service.metrics if service is not None else Metrics('apns')
+        self.connect_started = None
+        self.connections = 0
+        # paces this connection on top of the bucket of the whole service
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.error_status = None
+        # (write index of the last frame, spool start, frame ends, priority,
+        # time written) of the spooled chunks written on this connection
+        # and not acked yet
+        self.spooled = collections.deque()
+        self.written = 0
+        self.settle_call = None
 
     def addClient(self, p):
         log.msg('APNSClientFactory addClient %s' % p)
 
+        self.metrics.incr('connects')
+        if self.connections:
+            self.metrics.incr('reconnects')
+        self.connections += 1
+        if self.connect_started is not None:
+            self.metrics.observe('connect_seconds', time.time() - self.connect_started)
+            self.connect_started = None
+        self.error_status = None
         self.clientProtocol = p
+        if self.service is not None:
+            self.service.clientConnected(p)
+        self.resend()
         self.deferred.callback(p)
 
     def removeClient(self, p):
@@ -133,9 +543,160 @@ class APNSClientFactory(ReconnectingClientFactory):
         self.clientProtocol = None
         self.deferred = defer.Deferred()
         self.deferred.addErrback(log_errback('APNSClientFactory removeClient'))
+        if self.settle_call is not None and self.settle_call.active():
+            self.settle_call.cancel()
+        self.settle_call = None
+        if self.spooled:
+            self.redeliverSpooled()
+        if self.service is not None:
+            self.service.clientDisconnected(p)
+
+    def framesWritten(self, stream, chunk):
+        self.sent.extend(chunk)
+        self.written += len(chunk)
+        if not isinstance(stream, SpooledStream):
+            return
+        self.spooled.append((self.written, stream.chunk_start, stream.ends,
+                             stream.priority, time.time()))
+        # older frames left the resend window, APNS didn't object to them
+        self.ackSpooled(self.written - self.sent.maxlen)
+        self.settleLater()
+
+    def settleLater(self):
+        if self.settle_call is None and self.spooled:
+            delay = self.spooled[0][4] + SPOOL_SETTLE_DELAY - time.time()
+            self.settle_call = reactor.callLater(max(0, delay), self.settle)
+
+    def settle(self):
+        "Acks the spooled chunks the connection outlived by SPOOL_SETTLE_DELAY"
+        self.settle_call = None
+        if self.clientProtocol is None:
+            return
+        settled = time.time() - SPOOL_SETTLE_DELAY
+        spool = self.service.spool
+        while self.spooled and self.spooled[0][4] <= settled:
+            last, start, ends, priority, written_at = self.spooled.popleft()
+            spool.ack(start, ends[-1])
+        self.settleLater()
+
+    def ackSpooled(self, index):
+        "Acks the spooled chunks written up to the write `index`"
+        spool = self.service.spool
+        while self.spooled and self.spooled[0][0] <= index:
+            last, start, ends, priority, written_at = self.spooled.popleft()
+            spool.ack(start, ends[-1])
+
+    def redeliverSpooled(self):
+        """ The connection was lost with spooled chunks that may not have
+        made it. Everything up to the notification an error response named
+        was handled, the rest is delivered again. """
+        handled = 0
+        if self.failed_identifier is not None:
+            sent = list(self.sent)
+            for k, (identifier, token, frame) in enumerate(sent):
+                if identifier == self.failed_identifier:
+                    handled = self.written - len(sent) + k + 1
+                    break
+        spool = self.service.spool
+        retries = []
+        for last, start, ends, priority, written_at in self.spooled:
+            first = last - len(ends) + 1
+            if last <= handled:
+                spool.ack(start, ends[-1])
+            elif first <= handled:
+                k = handled - first
+                spool.ack(start, ends[k])
+                retries.append((ends[k], ends[-1], len(ends) - k - 1, priority))
+            else:
+                retries.append((start, ends[-1], len(ends), priority))
+        # the spool replaces the resend buffer
+        self.spooled.clear()
+        self.sent.clear()
+        self.written = 0
+        self.failed_identifier = None
+        log.msg('APNSClientFactory redelivering %d spooled notifications'
+                % sum(count for _, _, count, _ in retries))
+        self.service.redeliver_spooled(retries)
+
+    def errorReceived(self, p, status, identifier):
+        """ APNS rejected the notification with `identifier` and is about to
+        close the connection, dropping everything written after it """
+        log.msg('APNSClientFactory errorReceived status=%d identifier=%d'
+                % (status, identifier))
+
+        self.failed_identifier = identifier
+        self.error_status = status
+        self.metrics.incr('errors', status=status)
+        if status == ERROR_STATUS_SHUTDOWN:
+            # identifier is the last notification that was delivered
+            return
+        for i, token, frame in self.sent:
+            if i == identifier:
+                log.msg('APNSClientFactory notification failed token=%s status=%d (%s)'
+                        % (binascii.hexlify(token), status,
+                           ERROR_STATUS.get(status, 'Unknown')))
+                if status == ERROR_STATUS_INVALID_TOKEN and self.service is not None:
+                    self.service.invalidToken(token)
+                break
+
+    def resend(self):
+        "Resend everything written after the last failed notification"
+        if self.failed_identifier is None:
+            return
+        sent = list(self.sent)
+        self.sent.clear()
+        identifiers = [i for i, _, _ in sent]
+        if self.failed_identifier in identifiers:
+            resend = sent[identifiers.index(self.failed_identifier) + 1:]
+        else:
+            log.msg('APNSClientFactory identifier %d is out of the resend buffer'
+                    % self.failed_identifier)
+            resend = []
+        self.failed_identifier = None
+        if resend:
+            log.msg('APNSClientFactory resending %d notifications' % len(resend))
+            self.metrics.incr('notifications_resent', len(resend))
+            stream = NotificationStream(resend, PRIORITY_HIGH)
+            if self.service is not None:
+                # survives losing this connection again, like any stream
+                self.service.send(stream).addErrback(
+                    log_errback('APNSClientFactory resend'))
+            else:
+                self.clientProtocol.sendStream(stream)
+
+    def buckets(self):
+        "The token buckets pacing this connection"
+        service_bucket = getattr(self.service, 'bucket', None)
+        return [b for b in (service_bucket, self.bucket) if b is not None]
+
+    def allowance(self, count):
+        "How many of `count` notifications the pacing lets through now"
+        for bucket in self.buckets():
+            count = bucket.available(count)
+        return count
+
+    def consume(self, count):
+        for bucket in self.buckets():
+            bucket.take(count)
+
+    def pacingDelay(self):
+        "Seconds until the pacing lets another notification through"
+        return max([b.delay() for b in self.buckets()] or [0])
+
+    def backoff(self):
+        "The gateway dropped the connection, slow down"
+        buckets = self.buckets()
+        if not buckets:
+            return
+        for bucket in buckets:
+            bucket.backoff()
+        self.metrics.incr('pacing_backoffs')
+        log.msg('APNSClientFactory backing off to %.1f notifications/s'
+                % min(b.rate for b in buckets))
 
     def startedConnecting(self, connector):
         log.msg('APNSClientFactory startedConnecting')
+        self.connect_started = time.time()
 
     def buildProtocol(self, addr):
         self.resetDelay()
@@ -145,10 +706,15 @@ class APNSClientFactory(ReconnectingClientFactory):
 
     def clientConnectionLost(self, connector, reason):
         log.msg('APNSClientFactory clientConnectionLost reason=%s' % reason)
+        # closed by APNS, and not because of a bad notification
+        if self.continueTrying and self.error_status not in ERROR_STATUS_NOTIFICATION:
+            self.backoff()
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
         log.msg('APNSClientFactory clientConnectionFailed reason=%s' % reason)
+        self.metrics.incr('connect_failures')
+        self.connect_started = None
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
 
@@ -161,66 +727,449 @@ class APNSService(service.Service):
     clientProtocolFactory = APNSClientFactory
     feedbackProtocolFactory = APNSFeedbackClientFactory
 
-    def __init__(self, cert, environment, timeout=15):
-        self.factory = None
+    def __init__(self, cert, environment, timeout=15,
+                 command=COMMAND_ENHANCED, expiry=0,
+                 resend_buffer=RESEND_BUFFER_SIZE,
+                 pool_size=1, idle_timeout=IDLE_TIMEOUT,
+                 max_pending=MAX_PENDING, overflow=OVERFLOW_REJECT,
+                 inactive_path=None, gateway_address=None,
+                 feedback_address=None, reconnect_delay=RECONNECT_DELAY,
+                 max_reconnect_delay=MAX_RECONNECT_DELAY,
+                 backoff_factor=BACKOFF_FACTOR, spool_path=None,
+                 rate=None, burst=None, connection_rate=None):
+        self.factories = []
         self.environment = environment
+        # (host, port) overriding the gateways of the environment
+        self.gateway_address = gateway_address
+        self.feedback_address = feedback_address
         self.cert_path = cert
+        # the context of the certificate and the mtime of its file
+        self.context_factory = None
+        self.cert_mtime = None
         self.raw_mode = False
         self.timeout = timeout
+        self.command = command
+        self.expiry = expiry
+        self.resend_buffer = resend_buffer
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.backoff_factor = backoff_factor
+        # notifications/s of the whole service and of every connection
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.connection_rate = connection_rate
+        self.payloads = PayloadCache(command)
+        # tokens reported dead by feedback or error responses are skipped
+        self.inactive = InactiveTokens(inactive_path)
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.identifier = 0
+        self.streams = []
+        self.idle_call = None
+        # when notifications were last written, for the IdleReaper
+        self.last_used = None
+        # warm_up deferreds waiting for the first connection
+        self.connect_waiters = []
+        # (stream, count, spilled) waiting for the first connection
+        self.pending = collections.deque()
+        self.pending_count = 0
+        self.pending_memory = 0
+        self.pending_call = None
+        self.max_pending = max_pending
+        self.overflow = overflow
+        # replaced by one labelled with the app_id in create_service
+        self.metrics = Metrics('apns')
+        # notifications are appended to the spool before notify returns
+        # and replayed after a restart until they are written
+        self.spool = None
+        # (start, end, count, priority) spooled ranges that failed
+        self.spool_retries = []
+        if spool_path is not None:
+            self.spool = Spool(spool_path)
+            start, end, count = self.spool.unacked()
+            if count:
+                log.msg('APNSService replaying %d spooled notifications' % count)
+                reactor.callLater(0, self.deliver_spooled, start, end, count)
 
-    def getContextFactory(self):
-        return APNSClientContextFactory(self.cert_path)
+    def stopService(self):
+        "Save the inactive tokens and the spool checkpoint before exiting"
+        service.Service.stopService(self)
+        self.inactive.close()
+        if self.spool is not None:
+            self.spool.close()
 
-    def notify(self, token_or_token_list, payload):
-        "Connect to the APNS service and send notifications"
-        notifications = encode_notifications(
-            [t.replace(' ', '') for t in token_or_token_list]
-            if (type(token_or_token_list) is list)
-            else token_or_token_list.replace(' ', ''),
-            payload)
+    def getContextFactory(self, address=None):
+        "What to connect to the APNS endpoint `address` with"
+        self.current_context()
+        return APNSConnectionCreator(self, address)
+
+    def current_context(self):
+        """ The context of the certificate, reloaded once its file changed.
+        A certificate that fails to load leaves the previous one in place. """
+        if self.context_factory is not None and 'BEGIN CERTIFICATE' not in self.cert_path:
+            try:
+                mtime = os.stat(self.cert_path).st_mtime
+            except OSError:
+                mtime = self.cert_mtime
+            if mtime != self.cert_mtime:
+                try:
+                    self.reload_certificate()
+                except Exception, e:
+                    log.msg('APNSService keeping the previous certificate: %s' % e)
+        if self.context_factory is None:
+            self.reload_certificate()
+        return self.context_factory
+
+    def reload_certificate(self, cert=None):
+        """ Switches to `cert`, a path or a PEM string, or reloads the current
+        file. Live connections and everything queued keep going, the new
+        certificate is used from the next connect on. """
+        pem, mtime = read_certificate(cert or self.cert_path)
+        self.use_certificate(cert or self.cert_path, pem, mtime)
+
+    def preload_certificate(self):
+        """ Parses the certificate in a thread so that provisioning many apps
+        loads theirs in parallel, and their first connect doesn't """
+        cert = self.cert_path
+        def loaded(result):
+            pem, mtime, factory = result
+            self.use_certificate(cert, pem, mtime, factory)
+        return threads.deferToThread(load_certificate, cert).addCallback(loaded)
+
+    def use_certificate(self, cert, pem, mtime, factory=None):
+        factory = get_context_factory(pem, factory)
+        if factory is not self.context_factory:
+            log.msg('APNSService certificate loaded')
+        self.cert_path = cert
+        self.cert_mtime = mtime
+        self.context_factory = factory
 
-        if not self.factory:
+    def notify(self, token_or_token_list, payload, expiry=None,
+               priority=PRIORITY_NORMAL, delivered=False):
+        """ Connect to the APNS service and send notifications, in the lane
+        of `priority` ('high', 'normal' or 'bulk') """
+        if type(token_or_token_list) is not list:
+            token_or_token_list, payload = [token_or_token_list], [payload]
+        if type(payload) is not list:
+            payload = itertools.repeat(payload)
+        return self.write(iter_binary_tokens(token_or_token_list), payload,
+                          len(token_or_token_list), expiry, priority, delivered)
+
+    def broadcast(self, binary_tokens, payload, expiry=None,
+                  priority=PRIORITY_NORMAL):
+        """ Send the same notification to every token of `binary_tokens`,
+        a string of packed 32 byte binary tokens """
+        if len(binary_tokens) % 32:
+            raise ValueError('Packed tokens must be a multiple of 32 bytes')
+        tokens = (binary_tokens[i:i + 32]
+                  for i in xrange(0, len(binary_tokens), 32))
+        return self.write(tokens, itertools.repeat(payload),
+                          len(binary_tokens) // 32, expiry, priority)
+
+    def write(self, binary_tokens, payloads, count, expiry=None,
+              priority=PRIORITY_NORMAL, delivered=False):
+        """ Connect to the APNS service and write `count` notifications. A
+        spooled service fires once they are in the spool, or once the spool
+        let go of them with `delivered`. """
+        if expiry is None:
+            expiry = self.expiry
+        if priority not in LANES:
+            raise ValueError('Unknown priority %r' % priority)
+        if self.spool is not None:
+            return self.write_spooled(binary_tokens, payloads, expiry, priority,
+                                      delivered)
+
+        stream = NotificationStream(
+            self.encode(binary_tokens, payloads, expiry), priority)
+        return self.deliver(stream, count)
+
+    def write_spooled(self, binary_tokens, payloads, expiry,
+                      priority=PRIORITY_NORMAL, delivered=False):
+        """ Append the notifications to the spool, acknowledging right away
+        unless the caller waits for them to be `delivered` """
+        start, end, count = self.spool.append(
+            self.encode_payloads(binary_tokens, payloads), expiry)
+        self.deliver_spooled(start, end, count, priority)
+        if delivered:
+            return self.spool.acked_through(end)
+        return defer.succeed(None)
+
+    def encode_payloads(self, tokens, payloads):
+        "Lazily yields the (token, JSON payload) records of the spool"
+        last = encoded = None
+        for token, p in itertools.izip(tokens, payloads):
+            if p is not last:
+                encoded, last = self.payloads.get(p).payload, p
+            yield token, encoded
+
+    def deliver_spooled(self, start, end, count, priority=PRIORITY_NORMAL):
+        """ Sends a range of the spool. The connections ack it as their
+        writes are known to have made it, what wasn't handed to any is
+        retried on the next connection if the stream fails. """
+        stream = SpooledStream(self, start, end, count, priority)
+        def failed(err):
+            if stream.handed != end:
+                self.spool_retries.append((stream.handed, end,
+                                           max(0, count - stream.taken), priority))
+        self.deliver(stream, count).addErrback(failed)
+
+    def redeliver_spooled(self, ranges):
+        "Sends the (start, end, count, priority) ranges of the spool again"
+        for start, end, count, priority in ranges:
+            if start != end:
+                self.metrics.incr('notifications_resent', count)
+                self.deliver_spooled(start, end, count, priority)
+
+    def deliver(self, stream, count):
+        "Send the stream once a connection of the pool is up"
+        self.touch()
+        if len(self.factories) < self.pool_size:
             log.msg('APNSService write (connecting)')
-            server, port = ((APNS_SERVER_SANDBOX_HOSTNAME
-                             if self.environment == 'sandbox'
-                             else APNS_SERVER_HOSTNAME), APNS_SERVER_PORT)
-            self.factory = self.clientProtocolFactory()
-            context = self.getContextFactory()
-            reactor.connectSSL(server, port, self.factory, context)
-
-        client = self.factory.clientProtocol
-        if client:
-            client.sendMessage(notifications)
+            self.connect()
+
+        if self.clients():
+            return self.send(stream)
+
+        log.msg('APNSService waiting for connection')
+        d = self.enqueue(stream, count)
+        d.addErrback(log_errback('apns-service-write'))
+        return d
+
+    @property
+    def queue_depth(self):
+        "Number of notifications waiting for a connection"
+        return self.pending_count
+
+    @property
+    def pacing_active(self):
+        "Whether a token bucket is holding notifications back"
+        buckets = [f.bucket for f in self.factories] + [self.bucket]
+        return any(b.active for b in buckets if b is not None)
+
+    def encode(self, tokens, payloads, expiry):
+        "Lazily encodes (identifier, binary token, frame) notifications"
+        last = template = None
+        inactive = self.inactive
+        for token, p in itertools.izip(tokens, payloads):
+            if inactive.count and token in inactive:
+                self.metrics.incr('notifications_suppressed')
+                continue
+            if p is not last:
+                template, last = self.payloads.get(p), p
+            identifier = self.next_identifier()
+            yield identifier, token, template.stamp(token, identifier, expiry)
+
+    def encode_spooled(self, records):
+        "Lazily encodes (token, JSON payload, expiry) records of the spool"
+        last = template = None
+        inactive = self.inactive
+        for token, payload, expiry in records:
+            if inactive.count and token in inactive:
+                self.metrics.incr('notifications_suppressed')
+                continue
+            if payload != last:
+                template, last = self.payloads.template(payload), payload
+            identifier = self.next_identifier()
+            yield identifier, token, template.stamp(token, identifier, expiry)
+
+    def next_identifier(self):
+        self.identifier = (self.identifier + 1) & 0xffffffff
+        return self.identifier
+
+    def connect(self):
+        "Grow the pool of gateway connections up to `pool_size`"
+        server, port = self.gateway_address or (
+            (APNS_SERVER_SANDBOX_HOSTNAME if self.environment == 'sandbox'
+             else APNS_SERVER_HOSTNAME), APNS_SERVER_PORT)
+        while len(self.factories) < self.pool_size:
+            factory = self.clientProtocolFactory(
+                self, self.resend_buffer, self.reconnect_delay,
+                self.max_reconnect_delay, self.backoff_factor,
+                self.connection_rate)
+            self.factories.append(factory)
+            context = self.getContextFactory((server, port))
+            factory.connector = reactor.connectSSL(server, port, factory, context)
+        for observer in base.connect_observers:
+            observer(self)
+
+    def warm_up(self):
+        """ Opens the gateway connections ahead of the first notification.
+        Fires with whether one came up within `timeout` seconds, the pool
+        keeps trying otherwise. """
+        self.touch()
+        if len(self.factories) < self.pool_size:
+            self.connect()
+        if self.clients():
+            return defer.succeed(True)
+        d = defer.Deferred()
+        self.connect_waiters.append(d)
+        def timed_out():
+            if d in self.connect_waiters:
+                log.msg('APNSService warm up timed out after %i seconds'
+                        % self.timeout)
+                self.connect_waiters.remove(d)
+                d.callback(False)
+        call = reactor.callLater(self.timeout, timed_out)
+        def cancel(r):
+            if call.active():
+                call.cancel()
+            return r
+        return d.addBoth(cancel)
+
+    def clients(self):
+        "Returns the connected protocols of the pool"
+        return [f.clientProtocol for f in self.factories if f.clientProtocol]
+
+    def send(self, stream):
+        """ Hands the stream to every connected member of the pool, members
+        connecting later pick it up in clientConnected """
+        def finished(r):
+            self.streams.remove(stream)
+            return r
+        self.streams.append(stream)
+        stream.deferred.addBoth(finished)
+        for client in self.clients():
+            client.sendStream(stream)
+        return stream.deferred
+
+    def enqueue(self, stream, count):
+        """ Queues the stream until a connection of the pool is made, applying
+        the overflow policy once `max_pending` notifications are waiting """
+        spilled = False
+        if self.pending_memory + count > self.max_pending:
+            if self.overflow == OVERFLOW_DROP_OLDEST and count <= self.max_pending:
+                while self.pending_memory + count > self.max_pending:
+                    self.metrics.incr('notifications_dropped', self.pending[0][1])
+                    self.dequeue().fail(PendingQueueFullException(
+                        'Notification dropped from the pending queue'))
+            elif self.overflow == OVERFLOW_SPILL:
+                try:
+                    stream.notifications = unspill(spill(stream.notifications))
+                except Exception, e:
+                    stream.fail(e)
+                    return stream.deferred
+                spilled = True
+            else:
+                self.metrics.incr('notifications_dropped', count)
+                stream.fail(PendingQueueFullException(
+                    '%d notifications already pending' % self.pending_count))
+                return stream.deferred
+
+        self.pending.append((stream, count, spilled))
+        self.pending_count += count
+        if not spilled:
+            self.pending_memory += count
+        if self.pending_call is None:
+            self.pending_call = reactor.callLater(self.timeout, self.expire)
+        return stream.deferred
+
+    def dequeue(self):
+        stream, count, spilled = self.pending.popleft()
+        self.pending_count -= count
+        if not spilled:
+            self.pending_memory -= count
+        return stream
+
+    def expire(self):
+        """ Fails every pending notification once the shared deadline passes,
+        and the streams left unfinished by a pool that is still down """
+        self.pending_call = None
+        log.msg('APNSService %d pending notifications timed out' % self.pending_count)
+        self.metrics.incr('notifications_expired', self.pending_count)
+        while self.pending:
+            self.dequeue().fail(Exception(
+                'Notification timed out after %i seconds' % self.timeout))
+        if not self.clients():
+            for stream in list(self.streams):
+                stream.fail(Exception(
+                    'Connection lost, notification timed out after %i seconds'
+                    % self.timeout))
+
+    def clientConnected(self, protocol):
+        waiters, self.connect_waiters = self.connect_waiters, []
+        for d in waiters:
+            d.callback(True)
+        for stream in list(self.streams):
+            protocol.sendStream(stream)
+        if self.pending_call is not None:
+            self.pending_call.cancel()
+            self.pending_call = None
+        while self.pending:
+            self.send(self.dequeue())
+        retries, self.spool_retries = self.spool_retries, []
+        for start, end, count, priority in retries:
+            self.deliver_spooled(start, end, count, priority)
+
+    def clientDisconnected(self, protocol):
+        """ The last connection of the pool going down puts the streams it
+        didn't finish under the deadline of the pending notifications """
+        if self.streams and not self.clients() and self.pending_call is None:
+            self.pending_call = reactor.callLater(self.timeout, self.expire)
+
+    def touch(self):
+        "Postpone shrinking the pool while there is traffic"
+        self.last_used = time.time()
+        if not self.idle_timeout:
+            return
+        if self.idle_call is not None and self.idle_call.active():
+            self.idle_call.reset(self.idle_timeout)
         else:
-            log.msg('APNSService waiting for connection')
-            d = self.factory.deferred
-            timeout = reactor.callLater(self.timeout,
-                lambda: d.called or d.errback(
-                    Exception('Notification timed out after %i seconds' % self.timeout)))
-            def cancel_timeout(r):
-                try: timeout.cancel()
-                except: pass
-                return r
+            self.idle_call = reactor.callLater(self.idle_timeout, self.shrink)
+
+    def shrink(self):
+        "Close every gateway connection of the pool but one"
+        self.idle_call = None
+        if self.busy:
+            # a long or paced send isn't idle, look again later
+            self.idle_call = reactor.callLater(self.idle_timeout, self.shrink)
+            return
+        log.msg('APNSService shrinking idle pool of %d connections'
+                % len(self.factories))
+        while len(self.factories) > 1:
+            factory = self.factories.pop()
+            factory.stopTrying()
+            factory.connector.disconnect()
+
+    @property
+    def connection_count(self):
+        "Gateway connections open or being opened"
+        return len(self.factories)
 
-            def connected(protocol):
-                log.msg('APNSService connected, retrying sending')
-                protocol.sendMessage(notifications)
-                return protocol
+    @property
+    def busy(self):
+        "Whether notifications are being written or wait for a connection"
+        return bool(self.streams or self.pending or self.spool_retries or
+                    any(f.spooled for f in self.factories))
 
-            d.addCallback(connected)
-            d.addErrback(log_errback('apns-service-write'))
-            d.addBoth(cancel_timeout)
-            return d
+    def disconnect(self):
+        """ Close every gateway connection, the next notification opens the
+        pool again """
+        log.msg('APNSService closing %d gateway connections' % len(self.factories))
+        factories, self.factories = self.factories, []
+        for factory in factories:
+            factory.stopTrying()
+            factory.connector.disconnect()
+        if self.idle_call is not None and self.idle_call.active():
+            self.idle_call.cancel()
+        self.idle_call = None
 
-    def feedback(self):
-        "Connect to the feedback service and read all data."
+    def feedback(self, consumer=None, batch_size=FEEDBACK_BATCH_SIZE):
+        """ Connect to the feedback service and read all the (datetime,
+        token_str) records, or hand them to `consumer` in batches """
         log.msg('APNSService feedback (connecting)')
         try:
-            server, port = ((FEEDBACK_SERVER_SANDBOX_HOSTNAME
-                             if self.environment == 'sandbox'
-                             else FEEDBACK_SERVER_HOSTNAME), FEEDBACK_SERVER_PORT)
-            factory = self.feedbackProtocolFactory()
-            context = self.getContextFactory()
+            server, port = self.feedback_address or (
+                (FEEDBACK_SERVER_SANDBOX_HOSTNAME if self.environment == 'sandbox'
+                 else FEEDBACK_SERVER_HOSTNAME), FEEDBACK_SERVER_PORT)
+            collected = []
+            def consume(records):
+                self.markInactive(records)
+                if consumer is None:
+                    collected.extend(records)
+                else:
+                    consumer(records)
+
+            factory = self.feedbackProtocolFactory(consume, batch_size, self.metrics)
+            context = self.getContextFactory((server, port))
             reactor.connectSSL(server, port, factory, context)
             factory.deferred.addErrback(log_errback('apns-feedback-read'))
 
@@ -236,23 +1185,190 @@ class APNSService(service.Service):
         except Exception, e:
             log.msg('APNService feedback error initializing: %s' % str(e))
             raise
+        if consumer is None:
+            factory.deferred.addCallback(lambda count: collected)
         return factory.deferred
 
-def encode_notifications(tokens, notifications):
+    def markInactive(self, records):
+        "Remember the (datetime, token_str) feedback records"
+        for dt, token in records:
+            self.inactive.add(binascii.unhexlify(token), time.mktime(dt.timetuple()))
+        self.inactive.save_later()
+
+    def invalidToken(self, token):
+        "APNS rejected the binary `token` as invalid"
+        self.inactive.add(token)
+        self.inactive.save_later()
+
+    def reactivate(self, token_or_token_list, registered_at=None):
+        """ Stop suppressing tokens registered again after they went dark,
+        `registered_at` is a UNIX time and defaults to now """
+        if type(token_or_token_list) is not list:
+            token_or_token_list = [token_or_token_list]
+        for token in iter_binary_tokens(token_or_token_list):
+            self.inactive.reactivate(token, registered_at)
+        self.inactive.save_later()
+
+SIMPLE_PREFIX = struct.pack('!BH', COMMAND_SIMPLE, 32)
+ENHANCED_HEADER = struct.Struct('!BIIH')
+FRAME_HEADER = struct.Struct('!BIBH')
+FRAME_TRAILER = struct.Struct('!BHIBHIBHB')
+PAYLOAD_LENGTH = struct.Struct('!H')
+PAYLOAD_ITEM = struct.Struct('!BH')
+
+
+class PayloadTemplate(object):
+    """ A JSON encoded payload pre-framed for one command, stamped with
+    each token as prefix + token + suffix.
+    """
+
+    def __init__(self, payload, command=COMMAND_ENHANCED, priority=10):
+        if command == COMMAND_SIMPLE or command == COMMAND_ENHANCED:
+            self.suffix = PAYLOAD_LENGTH.pack(len(payload)) + payload
+        elif command == COMMAND_FRAME:
+            self.suffix = PAYLOAD_ITEM.pack(2, len(payload)) + payload
+            # token, payload, identifier, expiry and priority items
+            self.length = 3 + 32 + len(self.suffix) + FRAME_TRAILER.size
+        else:
+            raise ValueError('Unknown APNS command %r' % command)
+        self.command = command
+        self.priority = priority
+        self.payload = payload
+
+    def stamp(self, token, identifier=0, expiry=0):
+        if self.command == COMMAND_SIMPLE:
+            return SIMPLE_PREFIX + token + self.suffix
+        if self.command == COMMAND_ENHANCED:
+            return ENHANCED_HEADER.pack(
+                COMMAND_ENHANCED, identifier, expiry, 32) + token + self.suffix
+        return ''.join((
+            FRAME_HEADER.pack(COMMAND_FRAME, self.length, 1, 32), token,
+            self.suffix, FRAME_TRAILER.pack(3, 4, identifier, 4, 4, expiry,
+                                            5, 1, self.priority)))
+
+
+class PayloadCache(object):
+    """ The templates of recently serialized payloads, so an identical
+    payload is only framed once per broadcast. Payloads are told apart by
+    their JSON, 1 and 1.0 or True are different payloads to APNS.
+    """
+
+    def __init__(self, command=COMMAND_ENHANCED, size=PAYLOAD_CACHE_SIZE):
+        self.command = command
+        self.size = size
+        self.templates = {}
+
+    def get(self, payload):
+        # callers skip repeats of the same object, a mutated dict is
+        # encoded again
+        return self.template(JSON_ENCODER.encode(payload))
+
+    def template(self, encoded):
+        "The template of the JSON encoded payload"
+        template = self.templates.get(encoded)
+        if template is None:
+            templates = self.templates
+            if len(templates) >= self.size:
+                # cheaper than ordering every distinct payload of a batch
+                templates.clear()
+            template = templates[encoded] = PayloadTemplate(encoded, self.command)
+        return template
+
+
+def iter_binary_tokens(tokens, chunk_size=TOKEN_CHUNK_SIZE):
+    """ Converts hexlified tokens to binary, a chunk of them at a time """
+
+    tokens = iter(tokens)
+    for chunk in iter(lambda: list(itertools.islice(tokens, chunk_size)), []):
+        joined = ''.join(chunk)
+        if ' ' in joined:
+            joined = joined.replace(' ', '')
+        if len(joined) == 64 * len(chunk):
+            binary = binascii.unhexlify(joined)
+            for i in xrange(0, len(binary), 32):
+                yield binary[i:i + 32]
+        else:
+            for t in chunk:
+                yield struct.pack('32s', binascii.unhexlify(t.replace(' ', '')))
+
+def encode_notification(token, payload, identifier=0, expiry=0,
+                        command=COMMAND_ENHANCED, priority=10):
+    """ Returns the encoded bytes of a single notification
+
+          token        the binary device token
+          payload      the JSON encoded notification
+          identifier   an arbitrary value echoed back in error responses
+          expiry       UNIX epoch after which APNS may discard the notification
+          command      COMMAND_SIMPLE, COMMAND_ENHANCED or COMMAND_FRAME
+          priority     the delivery priority, only used by COMMAND_FRAME
+    """
+
+    return PayloadTemplate(payload, command, priority).stamp(
+        struct.pack('32s', token), identifier, expiry)
+
+def iter_notifications(tokens, notifications, identifiers=None, expiry=0,
+                       command=COMMAND_SIMPLE):
+    """ Lazily encodes paired tokens and notifications, one frame at a time
+
+          tokens          an iterable of tokens
+          notifications   an iterable of notifications
+          identifiers     an iterable of identifiers for the enhanced formats
+          expiry          expiry for the enhanced formats
+          command         the APNS command used to encode each notification
+    """
+
+    if identifiers is None:
+        identifiers = itertools.repeat(0)
+    cache = PayloadCache(command)
+    last = template = None
+    for t, p, i in itertools.izip(iter_binary_tokens(tokens), notifications, identifiers):
+        if p is not last:
+            template, last = cache.get(p), p
+        yield template.stamp(t, i, expiry)
+
+def encode_notifications(tokens, notifications, identifiers=None, expiry=0,
+                         command=COMMAND_SIMPLE):
     """ Returns the encoded bytes of tokens and notifications
 
           tokens          a list of tokens or a string of only one token
           notifications   a list of notifications or a dictionary of only one
+          identifiers     a list of identifiers for the enhanced formats
+          expiry          expiry for the enhanced formats
+          command         the APNS command used to encode each notification
     """
 
-    fmt = "!BH32sH%ds"
-    structify = lambda t, p: struct.pack(fmt % len(p), 0, 32, t, len(p), p)
-    binaryify = lambda t: t.decode('hex')
     if type(notifications) is dict and type(tokens) in (str, unicode):
         tokens, notifications = ([tokens], [notifications])
     if type(notifications) is list and type(tokens) is list:
-        return ''.join(map(lambda y: structify(*y), ((binaryify(t), json.dumps(p, separators=(',',':')))
-        for t, p in zip(tokens, notifications))))
+        return ''.join(iter_notifications(
+            tokens, notifications, identifiers, expiry, command))
+
+def iter_feedback(chunks):
+    """ Lazily yields the (datetime, token_str) records of an iterable of
+    chunks of the binary feedback stream """
+    decoder = FeedbackDecoder()
+    for chunk in chunks:
+        for record in decoder.feed(chunk):
+            yield record
+
+def spill(notifications):
+    "Writes (identifier, token, frame) notifications to a temporary file"
+    f = tempfile.TemporaryFile()
+    for identifier, token, frame in notifications:
+        f.write(SPILL_RECORD.pack(identifier, len(token), len(frame)))
+        f.write(token)
+        f.write(frame)
+    f.seek(0)
+    return f
+
+def unspill(f):
+    "Reads back the notifications written by spill"
+    with f:
+        header = f.read(SPILL_RECORD.size)
+        while header:
+            identifier, token_length, frame_length = SPILL_RECORD.unpack(header)
+            yield identifier, f.read(token_length), f.read(frame_length)
+            header = f.read(SPILL_RECORD.size)
 
 def log_errback(name):
     def _log_errback(err, *args):
@@ -1,5 +1,10 @@
 from twisted.python import log
+from twisted.internet import defer, reactor
 from zope.interface import Interface
+from pypns.stats import Metrics
+
+# per message logging, the hot paths check it before formatting anything
+DEBUG = False
 
 class IPNSService(Interface):
     """ Interface for PNS """
@@ -12,6 +17,8 @@ class IPNSService(Interface):
 
 factories = {}
 services = {}
+# called with every service about to open gateway connections
+connect_observers = []
 
 def register_factory(provider, factory):
     log.msg('register_factory {0}'.format(provider))
@@ -25,14 +32,78 @@ def create_service(app_id, provider, **kwargs):
         raise Exception('Unknown provider')
 
     service = factories[provider](**kwargs)
+    service.metrics = Metrics(provider, app_id)
     _add_service(app_id, provider, service)
 
+def create_services(apps, warm_up=False):
+    """ Provisions every app of a config, dicts with the `app_id`, the
+    `provider` ('apns' by default) and the options of the service. Apps
+    already provisioned are skipped.
+
+    Certificates are loaded in parallel, and with `warm_up` the gateway
+    connections are opened too. Fires with the status of every app_id once
+    all are done: 'ready', 'timeout' when its connection didn't come up in
+    time, or the error it failed with.
+    """
+    apps = [dict((str(k), v) for k, v in app.items()) for app in apps]
+    log.msg('create_services %d apps' % len(apps))
+
+    statuses = {}
+    ds = []
+    for options in apps:
+        app_id, provider = options.pop('app_id'), options.pop('provider', 'apns')
+        if has_service(app_id, provider):
+            statuses[app_id] = 'ready'
+            continue
+        try:
+            create_service(app_id, provider, **options)
+        except Exception, e:
+            statuses[app_id] = str(e)
+            continue
+        ds.append(_prepare_service(app_id, provider,
+                                   get_service(app_id, provider),
+                                   warm_up, statuses))
+
+    return defer.DeferredList(ds).addCallback(lambda r: statuses)
+
+def _prepare_service(app_id, provider, service, warm_up, statuses):
+    d = defer.maybeDeferred(getattr(service, 'preload_certificate', lambda: None))
+    if warm_up and hasattr(service, 'warm_up'):
+        d.addCallback(lambda r: service.warm_up())
+    else:
+        d.addCallback(lambda r: True)
+    def done(connected):
+        statuses[app_id] = 'ready' if connected else 'timeout'
+    def failed(err):
+        log.msg('create_services %s failed: %s' % (app_id, err.getErrorMessage()))
+        statuses[app_id] = err.getErrorMessage()
+        # so that provisioning it again retries instead of reporting it ready
+        _remove_service(app_id, provider)
+    return d.addCallbacks(done, failed)
+
+def has_service(app_id, provider):
+    return app_id in services and provider in services[app_id]
+
 def get_service(app_id, provider):
     if app_id not in services or provider not in services[app_id]:
         raise Exception('service not found')
     return services[app_id][provider]
 
+def stop_services():
+    "Lets every service save what it keeps on disk, run on shutdown"
+    for providers in services.values():
+        for service in providers.values():
+            if hasattr(service, 'stopService'):
+                service.stopService()
+
 def _add_service(app_id, provider, service):
     if not app_id in services:
         services[app_id] = {}
-    services[app_id][provider] = service
\ No newline at end of file
+    services[app_id][provider] = service
+
+def _remove_service(app_id, provider):
+    services.get(app_id, {}).pop(provider, None)
+    if app_id in services and not services[app_id]:
+        del services[app_id]
+
+reactor.addSystemEventTrigger('before', 'shutdown', stop_services)
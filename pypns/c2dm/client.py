@@ -1,19 +1,28 @@
 import os
+import time
 import binascii
 import urllib
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet import defer
-from twisted.internet.protocol import Protocol
-from twisted.application import service
-from twisted.web.client import Agent
+from twisted.internet import task
 from twisted.web.http_headers import Headers
-from twisted.web.iweb import IBodyProducer
 from zope.interface import implements
+from pypns import base
 from pypns.base import IPNSService
+from pypns.httppush import HTTPPushService, BufferProtocol, BufferProducer
+from pypns.inactive import digest_token
+from pypns.pacing import TokenBucket
+from pypns.stats import Metrics
 
 CLIENT_LOGIN_URL = 'https://www.google.com/accounts/ClientLogin'
 C2DM_URL = 'https://android.apis.google.com/c2dm/send'
+MAX_CONNECTIONS_PER_HOST = 8
+CONCURRENCY = 8
+# quota errors and 503s are retried that many times, waiting Retry-After
+# or RETRY_DELAY doubling every attempt
+MAX_RETRIES = 3
+RETRY_DELAY = 1.0
 
 class UnauthorizedException(Exception):
     pass
@@ -24,41 +33,18 @@ class InvalidRegistrationException(Exception):
 class NotRegisteredException(Exception):
     pass
 
-class BufferProtocol(Protocol):
-    def __init__(self):
-        self._buffer = ''
-        self.done = defer.Deferred()
-
-    def connectionMade(self):
-        pass
-
-    def dataReceived(self, bytes):
-        self._buffer += bytes
-
-    def connectionLost(self, reason):
-        self.done.callback(self._buffer)
-
-class BufferProducer(object):
-    implements(IBodyProducer)
-
-    def __init__(self, body):
-        self.body = body
-        self.length = len(body)
-
-    def startProducing(self, consumer):
-        consumer.write(self.body)
-        return defer.succeed(None)
-
-    def pauseProducing(self):
-        pass
+class QuotaExceededException(Exception):
+    pass
 
-    def resumeProducing(self):
-        pass
+class DeviceQuotaExceededException(Exception):
+    pass
 
-    def stopProducing(self):
-        pass
+class ServiceUnavailableException(Exception):
+    def __init__(self, retry_after=None):
+        Exception.__init__(self, 'C2DM service unavailable')
+        self.retry_after = retry_after
 
-class C2DMService(service.Service):
+class C2DMService(HTTPPushService):
     """
     A Service that sends notifications to the C2DM Service
     """
@@ -66,77 +52,167 @@ class C2DMService(service.Service):
 
     ERRORS = {
         'InvalidRegistration': InvalidRegistrationException,
-        'NotRegistered': NotRegisteredException
+        'NotRegistered': NotRegisteredException,
+        'QuotaExceeded': QuotaExceededException,
+        'DeviceQuotaExceeded': DeviceQuotaExceededException,
     }
 
-    def __init__(self, email, password, environment, timeout=15):
+    def __init__(self, email, password, environment, timeout=15,
+                 inactive_path=None,
+                 max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                 concurrency=CONCURRENCY, url=C2DM_URL,
+                 login_url=CLIENT_LOGIN_URL, rate=None, burst=None,
+                 max_retries=MAX_RETRIES):
         log.msg('C2DMService __init__')
-        self.agent = Agent(reactor)
-        self.token = None
+        # registration ids reported as NotRegistered are not sent again
+        HTTPPushService.__init__(self, inactive_path, max_connections_per_host,
+                                 concurrency)
         self.environment = environment
         self.email = email
         self.password = password
         self.timeout = timeout
-
-    @defer.inlineCallbacks
-    def notify(self, registration_id, payload):
+        self.url = url
+        self.login_url = login_url
+        # replaced by one labelled with the app_id in create_service
+        self.metrics = Metrics('c2dm')
+        # requests/s, slowed down by quota errors and 503s
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        # no request is sent before, after a Retry-After
+        self.retry_at = 0
+
+    @property
+    def pacing_active(self):
+        "Whether requests are held back by the rate or a Retry-After"
+        return (self.retry_at > time.time() or
+                (self.bucket is not None and self.bucket.active))
+
+    def pace(self):
+        "Fires once another request may be sent"
+        delay = self.retry_at - time.time()
+        if delay <= 0 and self.bucket is not None:
+            if self.bucket.available(1):
+                self.bucket.take(1)
+                return defer.succeed(None)
+            delay = self.bucket.delay()
+        if delay <= 0:
+            return defer.succeed(None)
+        self.metrics.incr('pacing_waits')
+        return task.deferLater(reactor, delay, self.pace)
+
+    def backoff(self, retry_after=None):
+        "Google pushed back, slow every request down"
+        self.metrics.incr('pacing_backoffs')
+        if retry_after:
+            self.retry_at = max(self.retry_at, time.time() + retry_after)
+        if self.bucket is not None:
+            self.bucket.backoff()
+            log.msg('C2DMService backing off to %.1f requests/s' % self.bucket.rate)
+
+    def notify(self, registration_id_or_list, payload_or_list):
         """
-        Connect to the C2DM service and send notifications
+        Connect to the C2DM service and send notifications. A list of
+        registration ids fires with a list of (registration_id, success,
+        message_id_or_error) results once every one has been sent.
         """
-        log.msg('notify %s' % registration_id)
+        if type(registration_id_or_list) is not list:
+            return self.semaphore.run(
+                self.notify_one, registration_id_or_list, payload_or_list)
+        # the notifications of a batch share their collapse key
+        return self.notify_all(registration_id_or_list, payload_or_list,
+                               binascii.hexlify(os.urandom(16)))
 
-        #TODO: Avoid making multiple get_token requests in parallel until you get the token
-        if not self.token:
-            self.token = yield self.get_token()
+    @defer.inlineCallbacks
+    def notify_one(self, registration_id, payload, collapse_key=None):
+        if base.DEBUG:
+            log.msg('notify %s' % registration_id)
 
-        try:
-            result = yield self.send_notify(registration_id, payload)
-        except UnauthorizedException:
-            self.token = yield self.get_token()
-            result = yield self.send_notify(registration_id, payload)
+        if self.inactive.count and digest_token(registration_id) in self.inactive:
+            self.metrics.incr('notifications_suppressed')
+            raise NotRegisteredException(
+                'Registration id %s is inactive' % registration_id)
 
-        defer.returnValue(result)
+        if not self.token:
+            yield self.refresh_token()
+
+        attempt = 0
+        while True:
+            yield self.pace()
+            token = self.token
+            try:
+                result = yield self.send_notify(registration_id, payload, collapse_key)
+            except UnauthorizedException:
+                yield self.refresh_token(token)
+                yield self.pace()
+                result = yield self.send_notify(registration_id, payload, collapse_key)
+            except (QuotaExceededException, ServiceUnavailableException), e:
+                retry_after = getattr(e, 'retry_after', None)
+                self.backoff(retry_after)
+                if attempt >= self.max_retries:
+                    raise
+                # everybody waits for a Retry-After, only this one otherwise
+                delay = retry_after or RETRY_DELAY * 2 ** attempt
+                attempt += 1
+                self.metrics.incr('retries')
+                yield task.deferLater(reactor, delay, lambda: None)
+                continue
+            defer.returnValue(result)
 
     @defer.inlineCallbacks
-    def send_notify(self, registration_id, payload):
-        log.msg('C2DMService.send_notify %s' % registration_id)
+    def send_notify(self, registration_id, payload, collapse_key=None):
+        if base.DEBUG:
+            log.msg('C2DMService.send_notify %s' % registration_id)
 
         values = {
-            'collapse_key' : binascii.hexlify(os.urandom(16)),
+            'collapse_key' : collapse_key or binascii.hexlify(os.urandom(16)),
             'registration_id' : registration_id,
             }
         for k,v in payload.iteritems():
             values['data.%s' % k] = v.encode('utf-8') if isinstance(v, basestring) else v
 
-        log.msg('C2DMService. starting request')
+        body = urllib.urlencode(values)
+        started = time.time()
         response = yield self.agent.request(
             'POST',
-            C2DM_URL,
+            self.url,
             Headers({
                 'Authorization': ['GoogleLogin auth=' + self.token],
                 'Content-Type': ['application/x-www-form-urlencoded']}),
-            BufferProducer(urllib.urlencode(values)))
+            BufferProducer(body))
 
-        log.msg('C2DMService.response %s' % urllib.urlencode(values))
-
-        if response.code == 401:
-            raise UnauthorizedException()
-        elif response.code != 200:
-            raise Exception('Invalid response code %d' % response.code)
+        if base.DEBUG:
+            log.msg('C2DMService.response %s' % body)
 
+        # always read the body so the connection goes back to the pool
         protocol = BufferProtocol()
         response.deliverBody(protocol)
 
         response_content = yield protocol.done
 
-        log.msg('C2DMService.response %s' % response_content)
+        self.metrics.observe('request_seconds', time.time() - started)
+        self.metrics.incr('responses', code=response.code)
+        self.metrics.incr('bytes_sent', len(body))
+
+        if response.code == 401:
+            raise UnauthorizedException()
+        elif response.code == 503:
+            raise ServiceUnavailableException(retry_after(response.headers))
+        elif response.code != 200:
+            raise Exception('Invalid response code %d' % response.code)
+
+        if base.DEBUG:
+            log.msg('C2DMService.response %s' % response_content)
 
         responseAsList = response_content.split('\n')
         key, val = responseAsList[0].split('=')
 
         if key == 'Error':
+            self.metrics.incr('errors', error=val)
+            if self.ERRORS.get(val) is NotRegisteredException:
+                self.markInactive(registration_id)
             raise self.ERRORS.get(val, Exception)('Error sending notification ' + val)
 
+        self.metrics.incr('notifications_sent')
         defer.returnValue(val)
 
     @defer.inlineCallbacks
@@ -153,7 +229,7 @@ class C2DMService(service.Service):
 
         response = yield self.agent.request(
             'POST',
-            CLIENT_LOGIN_URL,
+            self.login_url,
             Headers({
                 'Content-Type': ['application/x-www-form-urlencoded']
             }),
@@ -181,6 +257,16 @@ class C2DMService(service.Service):
 
         defer.returnValue(token)
 
+def retry_after(headers):
+    "Seconds of a Retry-After header, None without one or for an HTTP date"
+    values = headers.getRawHeaders('retry-after')
+    if not values:
+        return None
+    try:
+        return max(0, int(values[0]))
+    except ValueError:
+        return None
+
 def log_errback(name):
     def _log_errback(err, *args):
         log.msg('errback in %s : %s' % (name, str(err)))
@@ -1,10 +1,32 @@
+import json
+import time
+import urlparse
+import binascii
+import datetime
 import xmlrpclib
+import socket
 import threading
+import traceback
+import Queue
 import httplib
 import functools
 from sys import hexversion
 
-OPTIONS = {'CONFIGURED': False, 'TIMEOUT': 20}
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+OPTIONS = {'CONFIGURED': False, 'TIMEOUT': 20, 'TRANSPORT': 'xmlrpc',
+           'HTTP_PATH': 'json/', 'WORKERS': 4,
+           'BATCH': False, 'BATCH_SIZE': 500, 'BATCH_LATENCY': 0.02}
+
+# every thread keeps its own keep-alive connection to the server
+_local = threading.local()
+# worker threads running the async calls
+_workers = []
+_workers_lock = threading.Lock()
+_queue = Queue.Queue()
 
 def configure(opts):
   if not OPTIONS['CONFIGURED']:
@@ -39,7 +61,9 @@ def configure(opts):
 
 
 class UnknownAppID(Exception): pass
+class UnknownJob(Exception): pass
 class APNSNotConfigured(Exception): pass
+class HTTPTransportError(Exception): pass
 
 def reprovision_and_retry(func):
   """
@@ -77,27 +101,61 @@ def default_callback(func):
 
 @default_callback
 @reprovision_and_retry
-def provision(app_id, path_to_cert, environment, timeout=15, async=False, 
-              callback=None, errback=None):
-  args = [app_id, path_to_cert, environment, timeout]
+def provision(app_id, path_to_cert, environment, timeout=15, pool_size=1,
+              async=False, callback=None, errback=None):
+  args = [app_id, path_to_cert, environment, timeout, pool_size]
   f_args = ['provision', args, callback, errback]
   if not async:
     return _xmlrpc_thread(*f_args)
-  t = threading.Thread(target=_xmlrpc_thread, args=f_args)
-  t.daemon = True
-  t.start()
+  _submit(f_args)
 
 @default_callback
 @reprovision_and_retry
 def notify(app_id, tokens, notifications, async=False, callback=None, 
-           errback=None):
-  args = [app_id, tokens, notifications]
+           errback=None, provider='apns', priority=None):
+  args = [app_id, provider, tokens, notifications]
+  if priority is not None:
+    args.append(priority)
   f_args = ['notify', args, callback, errback]
+  if OPTIONS['BATCH']:
+    return _batcher.add(args, callback, errback, wait=not async)
   if not async:
     return _xmlrpc_thread(*f_args)
-  t = threading.Thread(target=_xmlrpc_thread, args=f_args)
-  t.daemon = True
-  t.start()
+  _submit(f_args)
+
+@default_callback
+@reprovision_and_retry
+def submit(app_id, tokens, notifications, async=False, callback=None,
+           errback=None, provider='apns', priority=None):
+  args = [app_id, provider, tokens, notifications]
+  if priority is not None:
+    args.append(priority)
+  f_args = ['submit', args, callback, errback]
+  if not async:
+    return _xmlrpc_thread(*f_args)
+  _submit(f_args)
+
+@default_callback
+def status(job_id, wait=0, async=False, callback=None, errback=None):
+  args = [job_id, wait]
+  f_args = ['status', args, callback, errback]
+  if not async:
+    return _xmlrpc_thread(*f_args)
+  _submit(f_args)
+
+@default_callback
+@reprovision_and_retry
+def broadcast(app_id, tokens, notification, async=False, callback=None,
+              errback=None, priority=None):
+  blob = xmlrpclib.Binary(''.join(t.replace(' ', '').decode('hex')
+                                  for t in tokens))
+  args = [app_id, 'apns', blob, notification]
+  if priority is not None:
+    args.append(priority)
+  f_args = ['broadcast', args, callback, errback]
+  if not async:
+    return _xmlrpc_thread(*f_args)
+  _submit(f_args)
 
 @default_callback
 @reprovision_and_retry
@@ -106,15 +164,141 @@ def feedback(app_id, async=False, callback=None, errback=None):
   f_args = ['feedback', args, callback, errback]
   if not async:
     return _xmlrpc_thread(*f_args)
-  t = threading.Thread(target=_xmlrpc_thread, args=f_args)
-  t.daemon = True
-  t.start()
+  _submit(f_args)
+
+def _submit(f_args):
+  """ Runs the call in the fixed size pool of worker threads """
+  with _workers_lock:
+    while len(_workers) < OPTIONS['WORKERS']:
+      t = threading.Thread(target=_worker)
+      t.daemon = True
+      t.start()
+      _workers.append(t)
+  _queue.put(f_args)
+
+def _worker():
+  while True:
+    f_args = _queue.get()
+    try:
+      try:
+        _xmlrpc_thread(*f_args)
+      except Exception, e:
+        # let batched callers waiting on the call know it failed
+        if f_args[3] is None:
+          raise
+        f_args[3](e)
+    except Exception:
+      traceback.print_exc()
+
+class _Batch(object):
+  def __init__(self, deadline):
+    self.deadline = deadline
+    self.tokens = []
+    self.notifications = []
+    # (offset, count, callback, errback) of every caller
+    self.callers = []
+
+class _Batcher(object):
+  """ Collects notify calls per app_id and sends them as one paired
+  token/notification list once BATCH_SIZE notifications are waiting or the
+  oldest one has waited BATCH_LATENCY seconds """
+
+  def __init__(self):
+    self.lock = threading.Condition()
+    self.batches = {}
+    self.thread = None
+
+  def add(self, args, callback, errback=None, wait=False):
+    tokens, notifications = args[2:4]
+    if not isinstance(tokens, list):
+      tokens, notifications = [tokens], [notifications]
+    elif not isinstance(notifications, list):
+      # the same notification to every token
+      notifications = [notifications] * len(tokens)
+    if wait:
+      return self.wait(args, callback, errback)
+
+    # app_id, provider and priority
+    key = tuple(args[:2] + args[4:])
+    with self.lock:
+      batch = self.batches.get(key)
+      if batch is None:
+        batch = self.batches[key] = _Batch(
+          time.time() + OPTIONS['BATCH_LATENCY'])
+      batch.callers.append((len(batch.tokens), len(tokens), callback, errback))
+      batch.tokens.extend(tokens)
+      batch.notifications.extend(notifications)
+      if len(batch.tokens) >= OPTIONS['BATCH_SIZE']:
+        del self.batches[key]
+        self.send(key, batch)
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+      self.lock.notify()
+
+  def wait(self, args, callback, errback):
+    """ Adds a synchronous call to the batch, blocking until it is sent """
+    done = threading.Event()
+    outcome = []
+    def _callback(r):
+      outcome.append((True, r))
+      done.set()
+    def _errback(e):
+      outcome.append((False, e))
+      done.set()
+    self.add(args, _callback, _errback)
+    if not done.wait(OPTIONS['TIMEOUT'] + OPTIONS['BATCH_LATENCY']):
+      raise socket.timeout('Batched notify timed out')
+    ok, result = outcome[0]
+    if ok:
+      return callback(result)
+    errback(result)
+
+  def run(self):
+    with self.lock:
+      while True:
+        now = time.time()
+        for key, batch in self.batches.items():
+          if batch.deadline <= now:
+            del self.batches[key]
+            self.send(key, batch)
+        deadlines = [b.deadline for b in self.batches.itervalues()]
+        self.lock.wait(min(deadlines) - now if deadlines else None)
+
+  def send(self, key, batch):
+    def _callback(result):
+      for offset, count, callback, errback in batch.callers:
+        # hand every caller its own slice of per recipient results
+        if isinstance(result, list) and len(result) == len(batch.tokens):
+          callback(result[offset:offset + count])
+        else:
+          callback(result)
+    def _errback(e):
+      for offset, count, callback, errback in batch.callers:
+        if errback is not None:
+          errback(e)
+    args = [key[0], key[1], batch.tokens, batch.notifications] + list(key[2:])
+    _submit(['notify', args, _callback, _errback])
+
+_batcher = _Batcher()
+
+def _proxy():
+  """ Returns the ServerProxy of the current thread, reusing its
+  connection as long as the configuration doesn't change """
+  key = (OPTIONS['HOST'], OPTIONS['TIMEOUT'])
+  if getattr(_local, 'proxy_key', None) != key:
+    _local.proxy = ServerProxy(OPTIONS['HOST'], allow_none=True,
+                               use_datetime=True, timeout=OPTIONS['TIMEOUT'])
+    _local.proxy_key = key
+  return _local.proxy
 
 def _xmlrpc_thread(method, args, callback, errback=None):
   if not configure({}):
     raise APNSNotConfigured('APNS Has not been configured.')
-  proxy = ServerProxy(OPTIONS['HOST'], allow_none=True, use_datetime=True,
-                      timeout=OPTIONS['TIMEOUT'])
+  if OPTIONS['TRANSPORT'] != 'xmlrpc':
+    return _http_thread(method, args, callback, errback)
+  proxy = _proxy()
   try:
     parts = method.strip().split('.')
     for part in parts:
@@ -122,12 +306,106 @@ def _xmlrpc_thread(method, args, callback, errback=None):
     return callback(proxy(*args))
   except xmlrpclib.Fault, e:
     if e.faultCode == 404:
-      e = UnknownAppID()
+      e = UnknownJob() if method == 'status' else UnknownAppID()
     if errback is not None:
       errback(e)
     else:
       raise e
 
+def _http_thread(method, args, callback, errback=None):
+  try:
+    return callback(_http_request(method, args))
+  except (UnknownAppID, UnknownJob, HTTPTransportError), e:
+    if errback is not None:
+      errback(e)
+    else:
+      raise e
+
+def _http_request(method, args):
+  """ Performs the API call against the JSON/msgpack HTTP resource of the
+  server instead of XML-RPC """
+  if method == 'provision':
+    app_id, cert, environment, timeout, pool_size = args
+    return _http_call('POST', 'provision', 'application/json', json.dumps({
+      'app_id': app_id, 'provider': 'apns', 'cert': cert,
+      'environment': environment, 'timeout': timeout, 'pool_size': pool_size}))
+  if method == 'feedback':
+    app_id, = args
+    return [(datetime.datetime.strptime(t, '%Y-%m-%dT%H:%M:%S'), token)
+            for t, token in _http_call('GET', 'feedback/%s/apns' % app_id,
+                                       lines=True)]
+  if method == 'status':
+    job_id, wait = args
+    try:
+      return _http_call('GET', 'status/%s?wait=%s' % (job_id, wait))
+    except UnknownAppID:
+      raise UnknownJob()
+  if method == 'broadcast':
+    app_id, provider, blob, notification = args[:4]
+    tokens = [binascii.hexlify(blob.data[i:i + 32])
+              for i in xrange(0, len(blob.data), 32)]
+    notifications = [notification] * len(tokens)
+  else:
+    app_id, provider, tokens, notifications = args[:4]
+  if not isinstance(tokens, list):
+    tokens, notifications = [tokens], [notifications]
+  if OPTIONS['TRANSPORT'] == 'msgpack':
+    content_type = 'application/x-msgpack'
+    body = ''.join(msgpack.packb([t, n], use_bin_type=True)
+                   for t, n in zip(tokens, notifications))
+  else:
+    content_type = 'application/x-ndjson'
+    body = '\n'.join(json.dumps([t, n], separators=(',',':'))
+                     for t, n in zip(tokens, notifications))
+  query = []
+  if args[4:]:
+    query.append('priority=%s' % args[4])
+  if method == 'submit':
+    query.append('accept=1')
+  path = 'notify/%s/%s' % (app_id, provider)
+  if query:
+    path += '?' + '&'.join(query)
+  result = _http_call('POST', path, content_type, body)
+  if method == 'submit':
+    return result['job_id']
+  return result.get('results')
+
+def _http_connection(netloc):
+  """ Returns the keep-alive HTTPConnection of the current thread """
+  key = (netloc, OPTIONS['TIMEOUT'])
+  if getattr(_local, 'http_key', None) != key:
+    if getattr(_local, 'http', None) is not None:
+      _local.http.close()
+    _local.http = httplib.HTTPConnection(netloc, timeout=OPTIONS['TIMEOUT'])
+    _local.http_key = key
+  return _local.http
+
+def _http_call(verb, path, content_type=None, body=None, lines=False):
+  url = urlparse.urlsplit(
+    urlparse.urljoin(OPTIONS['HOST'], OPTIONS['HTTP_PATH'] + path))
+  headers = {'Content-Type': content_type} if content_type else {}
+  conn = _http_connection(url.netloc)
+  for retry in (True, False):
+    try:
+      conn.request(verb, url.path + (url.query and '?' + url.query),
+                   body, headers)
+      response = conn.getresponse()
+      content = response.read()
+      break
+    except (httplib.HTTPException, socket.error):
+      # the server may have closed the idle connection, retry once
+      conn.close()
+      if not retry:
+        raise
+  if response.status == 200 and lines:
+    return [json.loads(line) for line in content.splitlines()]
+  result = json.loads(content)
+  if response.status == 404:
+    raise UnknownAppID()
+  if response.status != 200:
+    raise HTTPTransportError(result.get('error'))
+  return result
+
 
 ## --------------------------------------------------------------
 ## Thank you Volodymyr Orlenko:
@@ -146,8 +424,13 @@ class TimeoutTransport(xmlrpclib.Transport):
         conn = TimeoutHTTP(host)
         conn.set_timeout(self.timeout)
     else:
-        conn = TimeoutHTTPConnection(host)
+        # python 2.7 transports keep the connection alive between requests
+        if self._connection and host == self._connection[0]:
+          return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        conn = TimeoutHTTPConnection(chost)
         conn.timeout = self.timeout
+        self._connection = host, conn
     return conn
 
 class TimeoutHTTPConnection(httplib.HTTPConnection):
@@ -0,0 +1,270 @@
+""" Runs the XML-RPC server on several cores. A supervisor forks `workers`
+processes sharing its listening socket. Every worker owns the app_ids
+hashing to its shard, and forwards requests for the others to their owner
+over a private loopback port, so clients can talk to any of them.
+
+    python -m pypns.cluster --workers 4 [--port 7077] [--config conf.json]
+"""
+
+import os
+import sys
+import json
+import zlib
+import socket
+import optparse
+from twisted.python import log
+from twisted.internet import reactor, defer, protocol
+from twisted.web import resource, server, xmlrpc
+from pypns import jobs, stats
+from pypns.reaper import IdleReaper
+from pypns.server import PNSServer
+from pypns.web import MetricsResource
+
+# the methods taking the app_id as their first argument
+SHARDED_METHODS = ('provision', 'notify', 'submit', 'broadcast',
+                   'reactivate', 'feedback', 'stats', 'reload_certificate')
+LISTEN_FD = 3
+SHARD_FD = 4
+RESPAWN_DELAY = 1
+
+def shard(app_id, count):
+    "The index of the worker owning `app_id` out of `count`"
+    if isinstance(app_id, unicode):
+        app_id = app_id.encode('utf-8')
+    return (zlib.crc32(app_id) & 0xffffffff) % count
+
+
+class ShardedPNSServer(PNSServer):
+    """ A PNSServer serving the app_ids of shard `index`, forwarding calls
+    for every other app_id to the worker listening on `shard_ports[i]` """
+
+    def __init__(self, index, shard_ports):
+        PNSServer.__init__(self)
+        self.index = index
+        # job IDs tell which worker to ask for their status
+        jobs.table.prefix = '%d-' % index
+        self.proxies = [
+            xmlrpc.Proxy('http://127.0.0.1:%d/' % port, allowNone=True,
+                         useDateTime=True)
+            for port in shard_ports]
+
+    def owns(self, app_id):
+        return shard(app_id, len(self.proxies)) == self.index
+
+    def lookupProcedure(self, procedurePath):
+        function = PNSServer.lookupProcedure(self, procedurePath)
+        if procedurePath not in SHARDED_METHODS:
+            return function
+        def route(app_id=None, *args):
+            if app_id is None or self.owns(app_id):
+                return function(app_id, *args)
+            owner = self.proxies[shard(app_id, len(self.proxies))]
+            return owner.callRemote(procedurePath, app_id, *args)
+        return route
+
+    def xmlrpc_stats(self, app_id=None):
+        """ Reports the metrics of `app_id`, or the merged metrics of every
+        worker """
+        if app_id is not None:
+            return stats.snapshot(app_id)
+        d = defer.gatherResults([proxy.callRemote('shard_stats')
+                                 for proxy in self.proxies])
+        return d.addCallback(merge)
+
+    def xmlrpc_shard_stats(self):
+        "The metrics of the services of this worker only"
+        return stats.snapshot()
+
+    def xmlrpc_shard_metrics(self, app_id=None):
+        "The Prometheus text of the services of this worker only"
+        return stats.render_text(app_id)
+
+    def xmlrpc_status(self, job_id, wait=0):
+        "Asks the worker that accepted the job"
+        owner = job_shard(job_id)
+        if owner is None or owner == self.index or owner >= len(self.proxies):
+            return PNSServer.xmlrpc_status(self, job_id, wait)
+        return self.proxies[owner].callRemote('status', job_id, wait)
+
+    def xmlrpc_ready(self):
+        "Whether every worker provisioned its apps"
+        d = defer.gatherResults([proxy.callRemote('shard_ready')
+                                 for proxy in self.proxies])
+        return d.addCallback(all)
+
+    def xmlrpc_shard_ready(self):
+        return self.ready
+
+    def xmlrpc_provision_all(self, apps, warm_up=False):
+        "Provisions every app on the worker owning it"
+        apps_by_shard = dict((i, []) for i in xrange(len(self.proxies)))
+        for app in apps:
+            apps_by_shard[shard(app['app_id'], len(self.proxies))].append(app)
+        ds = [self.proxies[i].callRemote('shard_provision_all', owned, warm_up)
+              for i, owned in apps_by_shard.items() if owned]
+        return defer.gatherResults(ds).addCallback(merge)
+
+    def xmlrpc_shard_provision_all(self, apps, warm_up=False):
+        return PNSServer.xmlrpc_provision_all(self, apps, warm_up)
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self.index, reason)
+
+
+class Supervisor(object):
+    """ Binds the public and the shard ports, then spawns and respawns one
+    worker process per shard handing it the listening sockets """
+
+    def __init__(self, workers, port, interface='', config_path=None):
+        self.workers = workers
+        self.config_path = config_path
+        self.running = False
+        self.processes = {}
+        self.listener = listen_socket(interface, port)
+        self.shards = [listen_socket('127.0.0.1', 0) for _ in xrange(workers)]
+        self.shard_ports = [s.getsockname()[1] for s in self.shards]
+
+    def start(self):
+        self.running = True
+        for index in xrange(self.workers):
+            self.spawn(index)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, index):
+        args = [sys.executable, '-m', 'pypns.cluster', '--worker', str(index),
+                '--shard-ports', ','.join(map(str, self.shard_ports))]
+        if self.config_path:
+            args.extend(['--config', self.config_path])
+        log.msg('Supervisor spawning worker %d' % index)
+        self.processes[index] = reactor.spawnProcess(
+            WorkerProtocol(self, index), sys.executable, args, env=os.environ,
+            childFDs={0: 0, 1: 1, 2: 2, LISTEN_FD: self.listener.fileno(),
+                      SHARD_FD: self.shards[index].fileno()})
+
+    def workerEnded(self, index, reason):
+        log.msg('Supervisor worker %d ended %s' % (index, reason.getErrorMessage()))
+        del self.processes[index]
+        if self.running:
+            reactor.callLater(RESPAWN_DELAY, self.spawn, index)
+
+    def stop(self):
+        self.running = False
+        for process in self.processes.values():
+            try:
+                process.signalProcess('TERM')
+            except Exception:
+                pass
+
+
+class ShardedMetricsResource(MetricsResource):
+    """ The Prometheus text of every worker, or of the one owning the
+    app_id asked for """
+
+    def __init__(self, sharded):
+        MetricsResource.__init__(self)
+        self.sharded = sharded
+
+    def render_GET(self, request):
+        app_id = request.args.get('app_id', [None])[0]
+        proxies = self.sharded.proxies
+        if app_id is not None:
+            proxies = [proxies[shard(app_id, len(proxies))]]
+        d = defer.gatherResults([proxy.callRemote('shard_metrics', app_id)
+                                 for proxy in proxies])
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        def _write(texts):
+            if finished:
+                return
+            request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+            request.write(stats.merge_text(texts))
+            request.finish()
+        def _write_err(err):
+            log.msg('ShardedMetricsResource error %s' % err.getErrorMessage())
+            if finished:
+                return
+            request.setResponseCode(502)
+            request.finish()
+        d.addCallbacks(_write, _write_err)
+        return server.NOT_DONE_YET
+
+
+def merge(dicts):
+    "The dicts of every worker as a single one"
+    merged = {}
+    for d in dicts:
+        merged.update(d)
+    return merged
+
+def job_shard(job_id):
+    "The index of the worker that accepted `job_id`, if it names one"
+    index = job_id.split('-', 1)[0]
+    return int(index) if index.isdigit() else None
+
+def listen_socket(interface, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((interface, port))
+    s.listen(socket.SOMAXCONN)
+    s.setblocking(False)
+    return s
+
+def autoprovision(server, config):
+    "Provision the apps of the config owned by the shard of `server`"
+    apps = [app for app in config.get('autoprovision', [])
+            if server.owns(app['app_id'])]
+    server.autoprovision(apps, config.get('warm_up', False))
+
+def run_worker(index, shard_ports, config):
+    sharded = ShardedPNSServer(index, shard_ports)
+    root = resource.Resource()
+    root.putChild('', sharded)
+    root.putChild('metrics', ShardedMetricsResource(sharded))
+    site = server.Site(root)
+    reactor.adoptStreamPort(LISTEN_FD, socket.AF_INET, site)
+    reactor.adoptStreamPort(SHARD_FD, socket.AF_INET, site)
+    os.close(LISTEN_FD)
+    os.close(SHARD_FD)
+    if 'reaper' in config:
+        reaper = IdleReaper(**dict((str(k), v) for k, v in config['reaper'].items()))
+        reactor.callWhenRunning(reaper.startService)
+    reactor.callWhenRunning(autoprovision, sharded, config)
+    reactor.run()
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option('--workers', type='int', default=2,
+                      help='worker processes, one per core')
+    parser.add_option('--port', type='int',
+                      help='port to serve XML-RPC on, 7077 by default')
+    parser.add_option('--interface', default='')
+    parser.add_option('--config', help='JSON config, like example_conf.json')
+    parser.add_option('--worker', type='int', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--shard-ports', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    config = {}
+    if options.config:
+        with open(options.config) as f:
+            config = json.load(f)
+    log.startLogging(sys.stderr)
+
+    if options.worker is not None:
+        shard_ports = [int(p) for p in options.shard_ports.split(',')]
+        run_worker(options.worker, shard_ports, config)
+        return
+
+    port = options.port or config.get('port', 7077)
+    supervisor = Supervisor(options.workers, port, options.interface,
+                            options.config and os.path.abspath(options.config))
+    reactor.callWhenRunning(supervisor.start)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import itertools
+from twisted.internet import reactor
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.internet.protocol import Protocol
+from twisted.application import service
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.iweb import IBodyProducer
+from zope.interface import implements
+from pypns.inactive import InactiveTokens, digest_token
+
+class BufferProtocol(Protocol):
+    def __init__(self):
+        self._buffer = ''
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        pass
+
+    def dataReceived(self, bytes):
+        self._buffer += bytes
+
+    def connectionLost(self, reason):
+        self.done.callback(self._buffer)
+
+class BufferProducer(object):
+    implements(IBodyProducer)
+
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+class HTTPPushService(service.Service):
+    """
+    What the services sending one HTTP request per notification share: a
+    keep-alive connection pool, batches sent `concurrency` requests at a
+    time, a single-flight access token and the inactive tokens, which are
+    kept by digest as they are not 32 byte binaries.
+
+    Subclasses implement `notify_one(token, payload, *args)` and
+    `get_token()`.
+    """
+
+    def __init__(self, inactive_path=None, max_connections_per_host=8,
+                 concurrency=8):
+        # keep-alive connections so sends don't pay a TLS handshake each
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_connections_per_host
+        self.agent = Agent(reactor, pool=self.pool)
+        self.concurrency = concurrency
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.token = None
+        self.token_waiters = None
+        self.inactive = InactiveTokens(inactive_path)
+
+    def stopService(self):
+        "Save the inactive tokens before exiting"
+        service.Service.stopService(self)
+        self.inactive.close()
+
+    def notify(self, token_or_list, payload_or_list):
+        """
+        Send notifications. A list of tokens fires with a list of (token,
+        success, result_or_error) results once every one has been sent.
+        """
+        if type(token_or_list) is not list:
+            return self.semaphore.run(
+                self.notify_one, token_or_list, payload_or_list)
+        return self.notify_all(token_or_list, payload_or_list)
+
+    def notify_all(self, tokens, payload_or_list, *args):
+        "Sends to every token of the list, passing `args` to notify_one"
+        payloads = (payload_or_list if type(payload_or_list) is list
+                    else itertools.repeat(payload_or_list))
+        results = [None] * len(tokens)
+
+        def send(i, token, payload):
+            def ok(result):
+                results[i] = (token, True, result)
+            def failed(err):
+                results[i] = (token, False, err.getErrorMessage())
+            return self.semaphore.run(
+                self.notify_one, token, payload, *args).addCallbacks(ok, failed)
+
+        # only `concurrency` sends of the batch are scheduled at a time
+        work = (send(i, token, payload) for i, (token, payload)
+                in enumerate(itertools.izip(tokens, payloads)))
+        d = defer.DeferredList([task.cooperate(work).whenDone()
+                                for _ in xrange(self.concurrency)])
+        return d.addCallback(lambda r: results)
+
+    def refresh_token(self, stale=None):
+        """ Fetch a new access token, every caller waiting for one shares
+        the same request. A refresh because `stale` was rejected is skipped
+        when the token has already been replaced meanwhile. """
+        if stale is not None and self.token and self.token != stale:
+            return defer.succeed(self.token)
+        d = defer.Deferred()
+        if self.token_waiters is None:
+            self.token_waiters = [d]
+            self.get_token().addBoth(self._token_fetched)
+        else:
+            self.token_waiters.append(d)
+        return d
+
+    def _token_fetched(self, result):
+        waiters, self.token_waiters = self.token_waiters, None
+        if isinstance(result, Failure):
+            for d in waiters:
+                d.errback(result)
+        else:
+            self.use_token(result)
+            for d in waiters:
+                d.callback(self.token)
+
+    def use_token(self, result):
+        "Keeps what get_token fired with"
+        self.token = result
+
+    def markInactive(self, token):
+        self.inactive.add(digest_token(token))
+        self.inactive.save_later()
+
+    def reactivate(self, token_or_list, registered_at=None):
+        """ Stop suppressing tokens registered again after they went dark,
+        `registered_at` is a UNIX time and defaults to now """
+        if type(token_or_list) is not list:
+            token_or_list = [token_or_list]
+        for token in token_or_list:
+            self.inactive.reactivate(digest_token(token), registered_at)
+        self.inactive.save_later()
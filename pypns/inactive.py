@@ -0,0 +1,248 @@
+import os
+import time
+import hashlib
+import struct
+from twisted.python import log
+from twisted.internet import reactor, threads
+
+SLOT = struct.Struct('!32sI')
+HASH = struct.Struct('!Q')
+HEADER = struct.Struct('!8sQQ')
+MAGIC = 'pypnsit1'
+
+EMPTY = 0
+DELETED = 0xffffffff
+
+INITIAL_CAPACITY = 1024
+MAX_LOAD = 0.6
+SAVE_DELAY = 30
+JOURNAL_SUFFIX = '.journal'
+# the journal is folded into a new snapshot once it reaches this share of
+# the size of the table
+COMPACT_RATIO = 0.25
+
+class InactiveTokens(object):
+    """ The 32 byte binary tokens reported as inactive and the UNIX time
+    they went dark. Tokens live in an open addressing hash table packed in
+    a single bytearray (36 bytes a slot), so membership checks stay O(1)
+    without a Python object per token.
+
+    Given a `path` the table is loaded from it. Changes are appended to a
+    journal next to it, which a thread folds into a new snapshot from time
+    to time, so saving never writes the whole table on the reactor thread.
+    """
+
+    def __init__(self, path=None, capacity=INITIAL_CAPACITY):
+        self.path = None
+        self.save_call = None
+        self.journal = None
+        self.journal_size = 0
+        self.compacting = False
+        self.count = 0
+        self.used = 0
+        self.capacity = capacity
+        self.slots = bytearray(capacity * SLOT.size)
+        if path is not None:
+            self.load(path)
+        self.path = path
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, token):
+        return self.find(token) is not None
+
+    def get(self, token):
+        "Returns when `token` went dark or None"
+        offset = self.find(token)
+        if offset is not None:
+            return SLOT.unpack_from(self.slots, offset)[1]
+
+    def add(self, token, timestamp=None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        timestamp = min(max(int(timestamp), 1), DELETED - 1)
+        offset = self.find(token)
+        if offset is not None:
+            if timestamp > SLOT.unpack_from(self.slots, offset)[1]:
+                SLOT.pack_into(self.slots, offset, token, timestamp)
+                self.record(token, timestamp)
+            return
+        if (self.used + 1) > self.capacity * MAX_LOAD:
+            self.resize(self.capacity * 2 if self.count * 2 > self.used
+                        else self.capacity)
+        offset = self.probe(token)
+        if SLOT.unpack_from(self.slots, offset)[1] == EMPTY:
+            self.used += 1
+        SLOT.pack_into(self.slots, offset, token, timestamp)
+        self.count += 1
+        self.record(token, timestamp)
+
+    def remove(self, token):
+        offset = self.find(token)
+        if offset is not None:
+            SLOT.pack_into(self.slots, offset, '', DELETED)
+            self.count -= 1
+            self.record(token, DELETED)
+
+    def record(self, token, timestamp):
+        "Journals a change, written out by the next save"
+        if self.path is None:
+            return
+        if self.journal is None:
+            self.journal = open(self.path + JOURNAL_SUFFIX, 'ab')
+        self.journal.write(SLOT.pack(token, timestamp))
+        self.journal_size += SLOT.size
+
+    def reactivate(self, token, registered_at=None):
+        """ Forget `token` if it was registered again after it went dark,
+        returns whether it did """
+        went_dark = self.get(token)
+        if went_dark is None:
+            return False
+        if registered_at is None or registered_at > went_dark:
+            self.remove(token)
+            return True
+        return False
+
+    def find(self, token):
+        "Returns the offset of the slot holding `token` or None"
+        slots, size, capacity = self.slots, SLOT.size, self.capacity
+        i = HASH.unpack_from(token)[0] % capacity
+        while True:
+            offset = i * size
+            timestamp = SLOT.unpack_from(slots, offset)[1]
+            if timestamp == EMPTY:
+                return None
+            if timestamp != DELETED and slots[offset:offset + 32] == token:
+                return offset
+            i = (i + 1) % capacity
+
+    def probe(self, token):
+        "Returns the offset of the first free slot for `token`"
+        slots, size, capacity = self.slots, SLOT.size, self.capacity
+        i = HASH.unpack_from(token)[0] % capacity
+        while True:
+            offset = i * size
+            if SLOT.unpack_from(slots, offset)[1] in (EMPTY, DELETED):
+                return offset
+            i = (i + 1) % capacity
+
+    def resize(self, capacity):
+        "Rehash every live token into a table of `capacity` slots"
+        old = self.slots
+        self.capacity = capacity
+        self.slots = bytearray(capacity * SLOT.size)
+        self.count = self.used = 0
+        for token, timestamp in iter_slots(old):
+            SLOT.pack_into(self.slots, self.probe(token), token, timestamp)
+            self.count += 1
+            self.used += 1
+
+    def __iter__(self):
+        "Yields the (token, timestamp) of every inactive token"
+        return iter_slots(self.slots)
+
+    def load(self, path):
+        "Reads the snapshot at `path`, then replays the journals after it"
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                magic, capacity, count = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC:
+                    raise ValueError('%s is not an inactive tokens file' % path)
+                self.slots = bytearray(f.read())
+            self.capacity = capacity
+            # drops the tombstones
+            self.resize(capacity)
+            log.msg('InactiveTokens loaded %d tokens from %s' % (count, path))
+        for name in (path + JOURNAL_SUFFIX + '.old', path + JOURNAL_SUFFIX):
+            if os.path.exists(name):
+                self.journal_size = self.replay(name)
+
+    def replay(self, name):
+        """ Applies the changes of a journal, returns its size once a torn
+        last record is cut off """
+        with open(name, 'r+b') as f:
+            data = f.read()
+            end = len(data) - len(data) % SLOT.size
+            if end != len(data):
+                # later changes are appended right after the last whole one
+                f.truncate(end)
+        for offset in xrange(0, end, SLOT.size):
+            token, timestamp = SLOT.unpack_from(data, offset)
+            if timestamp == DELETED:
+                self.remove(token)
+            else:
+                self.add(token, timestamp)
+        log.msg('InactiveTokens replayed %d changes from %s'
+                % (end // SLOT.size, name))
+        return end
+
+    def save(self):
+        """ Flush the journal, and fold it into a new snapshot written by a
+        thread once it grew past COMPACT_RATIO of the table """
+        self.save_call = None
+        if self.journal is None:
+            return
+        self.journal.flush()
+        if not self.compacting and self.journal_size > len(self.slots) * COMPACT_RATIO:
+            self.compact()
+
+    def compact(self):
+        "Start a new journal and snapshot the table in a thread"
+        self.journal.close()
+        self.journal = None
+        self.journal_size = 0
+        name = self.path + JOURNAL_SUFFIX
+        if os.path.exists(name + '.old'):
+            # the previous snapshot didn't finish, keep both journals
+            with open(name + '.old', 'ab') as old, open(name, 'rb') as f:
+                old.write(f.read())
+            os.remove(name)
+        else:
+            os.rename(name, name + '.old')
+        self.compacting = True
+        # copied here, the table keeps changing while the thread writes
+        d = threads.deferToThread(
+            write_snapshot, self.path,
+            HEADER.pack(MAGIC, self.capacity, self.count), str(self.slots))
+        def done(r):
+            self.compacting = False
+            return r
+        d.addBoth(done).addErrback(
+            lambda err: log.msg('InactiveTokens snapshot failed: %s' % err))
+
+    def save_later(self, delay=SAVE_DELAY):
+        "Coalesce the writes of many updates into one save"
+        if self.path is not None and self.save_call is None:
+            self.save_call = reactor.callLater(delay, self.save)
+
+    def close(self):
+        "Write the pending changes right away"
+        if self.save_call is not None and self.save_call.active():
+            self.save_call.cancel()
+        self.save_call = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+def write_snapshot(path, header, slots):
+    "Atomically writes the table to `path`, then drops the journal it folds"
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(slots)
+    os.rename(tmp, path)
+    os.remove(path + JOURNAL_SUFFIX + '.old')
+
+def iter_slots(slots):
+    for offset in xrange(0, len(slots), SLOT.size):
+        token, timestamp = SLOT.unpack_from(slots, offset)
+        if timestamp != EMPTY and timestamp != DELETED:
+            yield token, timestamp
+
+def digest_token(token):
+    "A 32 byte key for tokens that are not 32 byte binaries themselves"
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).digest()
@@ -0,0 +1,148 @@
+import os
+import time
+import binascii
+import collections
+from twisted.internet import reactor, defer
+
+# jobs kept in memory, the oldest are forgotten first
+MAX_JOBS = 10000
+# failed tokens remembered per job, the rest are only counted
+MAX_FAILED_TOKENS = 1000
+# longest a status call may wait for a job to finish
+MAX_WAIT = 60
+
+QUEUED = 'queued'
+WRITTEN = 'written'
+FAILED = 'failed'
+
+
+class UnknownJobException(Exception):
+    pass
+
+
+class Job(object):
+    """ The delivery state of notifications accepted before they were
+    written: QUEUED until the deferred of the service fires, then WRITTEN
+    or FAILED. Providers reporting a result per recipient also fill in the
+    tokens that failed. """
+
+    def __init__(self, job_id, app_id, provider, count):
+        self.job_id = job_id
+        self.app_id = app_id
+        self.provider = provider
+        self.count = count
+        self.state = QUEUED
+        self.written = 0
+        self.failed = 0
+        self.failed_tokens = []
+        self.error = None
+        self.queued_at = time.time()
+        self.finished_at = None
+        self.waiters = []
+
+    @property
+    def done(self):
+        return self.state != QUEUED
+
+    def finish(self, result):
+        "The service wrote the notifications"
+        if type(result) is list:
+            # (token, success, message_id_or_error) per recipient
+            for token, success, message in result:
+                if success:
+                    self.written += 1
+                else:
+                    self.tokenFailed(token, message)
+        else:
+            self.written = self.count
+        self.finished(WRITTEN if self.written or not self.count else FAILED)
+
+    def abort(self, err):
+        "The notifications could not be written"
+        self.error = err.getErrorMessage()
+        self.failed = self.count - self.written
+        self.finished(FAILED)
+
+    def tokenFailed(self, token, error):
+        self.failed += 1
+        if len(self.failed_tokens) < MAX_FAILED_TOKENS:
+            self.failed_tokens.append((token, error))
+
+    def finished(self, state):
+        self.state = state
+        self.finished_at = time.time()
+        self.release()
+
+    def release(self):
+        "Fires every waiting status call with the current state"
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(self.snapshot())
+
+    def wait(self, timeout):
+        "Fires with the snapshot once the job is done or `timeout` passed"
+        if self.done or timeout <= 0:
+            return defer.succeed(self.snapshot())
+        d = defer.Deferred()
+        self.waiters.append(d)
+        call = reactor.callLater(min(timeout, MAX_WAIT), self.timedOut, d)
+        def cancel(r):
+            if call.active():
+                call.cancel()
+            return r
+        return d.addBoth(cancel)
+
+    def timedOut(self, d):
+        if d in self.waiters:
+            self.waiters.remove(d)
+            d.callback(self.snapshot())
+
+    def snapshot(self):
+        return {
+            'job_id': self.job_id,
+            'app_id': self.app_id,
+            'provider': self.provider,
+            'state': self.state,
+            'count': self.count,
+            'written': self.written,
+            'failed': self.failed,
+            'failed_tokens': list(self.failed_tokens),
+            'error': self.error,
+            'queued_at': self.queued_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobTable(object):
+    """ The last `max_jobs` jobs by job ID. Job IDs start with `prefix`,
+    which tells the cluster the worker that owns them. """
+
+    def __init__(self, max_jobs=MAX_JOBS, prefix=''):
+        self.max_jobs = max_jobs
+        self.prefix = prefix
+        self.jobs = collections.OrderedDict()
+
+    def add(self, app_id, provider, count, d):
+        "Tracks the notifications written once `d` fires"
+        job_id = self.prefix + binascii.hexlify(os.urandom(8))
+        job = self.jobs[job_id] = Job(job_id, app_id, provider, count)
+        while len(self.jobs) > self.max_jobs:
+            _, evicted = self.jobs.popitem(last=False)
+            evicted.release()
+        d.addCallbacks(job.finish, job.abort)
+        return job
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise UnknownJobException('Unknown job %s' % job_id)
+        return job
+
+    def owns(self, job_id):
+        return job_id.startswith(self.prefix)
+
+    def __len__(self):
+        return len(self.jobs)
+
+# the jobs of this process, shared by the XML-RPC and the HTTP interface
+table = JobTable()
@@ -0,0 +1,67 @@
+import time
+
+# a full bucket holds that many seconds worth of notifications
+BURST_SECONDS = 1.0
+# the rate is cut by BACKOFF after the gateway pushed back, down to
+# MIN_RATE of the target, and regains RECOVERY of the target every second
+BACKOFF = 0.5
+MIN_RATE = 0.05
+RECOVERY = 0.1
+# seconds a bucket counts as limiting after it last held something back
+ACTIVE_WINDOW = 1.0
+
+
+class TokenBucket(object):
+    """ Lets `rate` notifications a second through on average, in bursts
+    of up to `burst`. Every `backoff` halves the rate, which then climbs
+    back linearly to `rate` (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, rate, burst=None, recovery=RECOVERY, clock=time.time):
+        self.target = self.rate = float(rate)
+        self.burst = burst or max(1, int(rate * BURST_SECONDS))
+        self.recovery = recovery
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.limited_at = None
+
+    def refill(self):
+        now = self.clock()
+        elapsed = max(0.0, now - self.updated)
+        self.updated = now
+        if self.rate < self.target:
+            self.rate = min(self.target,
+                            self.rate + self.target * self.recovery * elapsed)
+        self.tokens = min(self.burst, self.tokens + self.rate * elapsed)
+
+    def available(self, count):
+        "How many of `count` notifications may be sent right now"
+        self.refill()
+        allowed = min(count, int(self.tokens))
+        if allowed < count:
+            self.limited_at = self.updated
+        return max(0, allowed)
+
+    def take(self, count):
+        self.tokens -= count
+
+    def delay(self, count=1):
+        "Seconds until `count` more notifications may be sent"
+        return max(0.0, (min(count, self.burst) - self.tokens) / self.rate)
+
+    def backoff(self):
+        "The gateway pushed back, slow down"
+        self.refill()
+        self.rate = max(self.target * MIN_RATE, self.rate * BACKOFF)
+        self.tokens = min(self.tokens, self.rate * BURST_SECONDS)
+        self.limited_at = self.updated
+
+    @property
+    def active(self):
+        "Whether the bucket is holding notifications back"
+        self.refill()
+        if self.rate < self.target:
+            return True
+        return (self.limited_at is not None and
+                self.clock() - self.limited_at < ACTIVE_WINDOW)
@@ -0,0 +1,89 @@
+import time
+from twisted.python import log
+from twisted.internet import task
+from twisted.application import service
+from pypns import base
+
+IDLE_TIMEOUT = 600
+INTERVAL = 30
+# apps that sent this recently are never closed to make room for others
+WARM_TIME = 60
+
+
+class IdleReaper(service.Service):
+    """ Closes the gateway connections of the provisioned apps that haven't
+    sent anything for `idle_timeout` seconds, and of the least recently
+    used ones whenever more than `max_connections` are open. Closed apps
+    reconnect on their next notification.
+
+    Apps are checked every `interval` seconds, and as soon as one opens
+    connections. Those busy writing or waiting for a connection and those
+    used in the last `warm_time` seconds are left alone.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_connections=None,
+                 interval=INTERVAL, warm_time=WARM_TIME):
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.interval = interval
+        self.warm_time = warm_time
+        self.call = None
+
+    def startService(self):
+        service.Service.startService(self)
+        base.connect_observers.append(self.serviceConnecting)
+        self.call = task.LoopingCall(self.reap)
+        self.call.start(self.interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        base.connect_observers.remove(self.serviceConnecting)
+        if self.call is not None and self.call.running:
+            self.call.stop()
+        self.call = None
+
+    def connected(self):
+        "The services with gateway connections"
+        return [s for providers in base.services.values()
+                for s in providers.values()
+                if getattr(s, 'connection_count', 0)]
+
+    def reap(self):
+        "Close idle services, then the least recently used over the cap"
+        now = time.time()
+        live = []
+        for s in self.connected():
+            if (self.idle_timeout and not s.busy and
+                    now - (s.last_used or 0) > self.idle_timeout):
+                self.close(s, 'idle')
+            else:
+                live.append(s)
+        self.enforce(live, now)
+
+    def serviceConnecting(self, connecting):
+        if self.max_connections is None:
+            return
+        live = [s for s in self.connected() if s is not connecting]
+        # the connections the service is opening count towards the cap
+        self.enforce(live, time.time(), connecting.connection_count)
+
+    def enforce(self, live, now, opening=0):
+        if self.max_connections is None:
+            return
+        count = opening + sum(s.connection_count for s in live)
+        if count <= self.max_connections:
+            return
+        for s in sorted(live, key=lambda s: s.last_used or 0):
+            if count <= self.max_connections:
+                break
+            if s.busy or now - (s.last_used or 0) < self.warm_time:
+                continue
+            count -= s.connection_count
+            self.close(s, 'lru')
+        if count > self.max_connections:
+            log.msg('IdleReaper %d connections open, over the cap of %d'
+                    % (count, self.max_connections))
+
+    def close(self, s, reason):
+        s.metrics.incr('connections_reaped', s.connection_count, reason=reason)
+        s.disconnect()
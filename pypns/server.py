@@ -1,16 +1,67 @@
-import struct
-import binascii
-import datetime
+import time
+from twisted.python import log
+from twisted.internet import defer
 from twisted.web import xmlrpc
-from base import create_service, get_service
+from OpenSSL import SSL, crypto
+import stats
+import jobs
+from base import create_service, create_services, get_service, has_service
+from apns.client import APNSService, LANES, iter_feedback
 
 class PNSServer(xmlrpc.XMLRPC):
   def __init__(self):
     self.use_date_time = True
     self.useDateTime = True
+    # False while autoprovision is loading certificates and connecting
+    self.ready = True
     xmlrpc.XMLRPC.__init__(self, allowNone=True)
 
-  def xmlrpc_notify(self, app_id, provider, token_or_token_list, aps_dict_or_list):
+  def autoprovision(self, apps, warm_up=False):
+    """ Provisions the apps of a config in parallel, `ready` turns True once
+    they all are, connected to their gateway with `warm_up` """
+    self.ready = False
+    def done(statuses):
+      for app_id, status in statuses.items():
+        if status != 'ready':
+          log.msg('autoprovision %s: %s' % (app_id, status))
+      self.ready = True
+      return statuses
+    return create_services(apps, warm_up).addCallback(done)
+
+  def xmlrpc_provision(self, app_id, path_to_cert_or_cert, environment,
+                       timeout=15, pool_size=1, spool_path=None, rate=None,
+                       connection_rate=None):
+    """ Starts an APNS service for the provided application_id. Attempts
+    to provision the same application id multiple times are ignored.
+
+      Arguments:
+          app_id                 the app_id to provision for APNS
+          path_to_cert_or_cert   absolute path to the APNS SSL cert or a
+                                 string containing the .pem file
+          environment            either 'sandbox' or 'production'
+          timeout                seconds to timeout connection attempts
+                                 to the APNS server
+          pool_size              number of parallel connections to the
+                                 APNS gateway
+          spool_path             directory of the app's on-disk spool,
+                                 notify returns once notifications are
+                                 appended to it
+          rate                   notifications per second to pace the
+                                 app to, backing off when APNS drops
+                                 the connection
+          connection_rate        notifications per second of every
+                                 pooled connection
+      Returns:
+          None
+    """
+    if not has_service(app_id, 'apns'):
+      create_service(app_id, 'apns', cert=path_to_cert_or_cert,
+                     environment=environment, timeout=timeout,
+                     pool_size=pool_size, spool_path=spool_path,
+                     rate=rate, connection_rate=connection_rate)
+
+  def xmlrpc_notify(self, app_id, provider, token_or_token_list, aps_dict_or_list,
+                    priority=None):
     """ Sends push notifications to the PNS server. Multiple 
     notifications can be sent by sending pairing the token/notification
     arguments in lists [token1, token2], [notification1, notification2].
@@ -19,10 +70,14 @@ class PNSServer(xmlrpc.XMLRPC):
           app_id                provisioned app_id to send to
           token_or_token_list   token to send the notification or a list of tokens
           aps_dict_or_list      notification dicts or a list of notifications
+          priority              OPTIONAL, 'high', 'normal' or 'bulk', APNS only
       Returns:
-          None
+          None, or a list of (token, success, message_id_or_error) for
+          providers reporting a result per recipient
     """
-    d = get_service(app_id, provider).notify(token_or_token_list, aps_dict_or_list)
+    service = get_service(app_id, provider)
+    kwargs = priority_kwargs(service, provider, priority)
+    d = service.notify(token_or_token_list, aps_dict_or_list, **kwargs)
     if d:
       def _finish_err(r):
         # so far, the only error that could really become of this
@@ -30,7 +85,105 @@ class PNSServer(xmlrpc.XMLRPC):
         # that are made unsuccessfully, which twisted will try endlessly
         # to reconnect to, we timeout and notifify the client
         raise xmlrpc.Fault(500, 'Connection to the PNS server could not be made.')
-      return d.addCallbacks(lambda r: None, _finish_err)
+      return d.addCallbacks(lambda r: r if type(r) is list else None, _finish_err)
+
+  def xmlrpc_submit(self, app_id, provider, token_or_token_list, aps_dict_or_list,
+                    priority=None):
+    """ Accepts push notifications like notify, but returns a job ID as soon
+    as they are queued instead of waiting for the PNS server. Pass the job
+    ID to status to learn whether they were written.
+
+      Arguments:
+          app_id                provisioned app_id to send to
+          token_or_token_list   token to send the notification or a list of tokens
+          aps_dict_or_list      notification dicts or a list of notifications
+          priority              OPTIONAL, 'high', 'normal' or 'bulk', APNS only
+      Returns:
+          The job ID string
+    """
+    service = get_service(app_id, provider)
+    kwargs = priority_kwargs(service, provider, priority)
+    if type(token_or_token_list) is list:
+      count = len(token_or_token_list)
+      if type(aps_dict_or_list) is list and len(aps_dict_or_list) != count:
+        raise xmlrpc.Fault(400, '%d tokens but %d notifications' % (
+          count, len(aps_dict_or_list)))
+    else:
+      count = 1
+    if getattr(service, 'spool', None) is not None:
+      # spooling isn't delivering, the job is queued until the spool is acked
+      kwargs['delivered'] = True
+    try:
+      d = service.notify(token_or_token_list, aps_dict_or_list, **kwargs)
+    except ValueError, e:
+      raise xmlrpc.Fault(400, str(e))
+    job = jobs.table.add(app_id, provider, count, d or defer.succeed(None))
+    if job.state == jobs.FAILED and job.error is not None:
+      # refused right away, like a full pending queue
+      raise xmlrpc.Fault(503, job.error)
+    return job.job_id
+
+  def xmlrpc_status(self, job_id, wait=0):
+    """ Reports the delivery state of the notifications of a job. A `wait`
+    holds the response until the job is done, at most that many seconds.
+
+      Arguments:
+          job_id   the job ID returned by submit
+          wait     OPTIONAL, seconds to wait for the job to finish, up
+                   to 60
+      Returns:
+          Struct of the job's state ('queued', 'written' or 'failed'),
+          count, written and failed counts, failed_tokens as (token,
+          error) tuples, error, queued_at and finished_at UNIX times
+    """
+    try:
+      job = jobs.table.get(job_id)
+    except jobs.UnknownJobException, e:
+      raise xmlrpc.Fault(404, str(e))
+    return job.wait(wait)
+
+  def xmlrpc_broadcast(self, app_id, provider, tokens, aps_dict, priority=None):
+    """ Sends the same push notification to many devices. The tokens
+    are packed in a single binary blob of 32 bytes binary tokens instead
+    of a list of hexlified strings.
+
+      Arguments:
+          app_id     provisioned app_id to send to
+          provider   the provider of the app, only 'apns' supports it
+          tokens     xmlrpclib.Binary with the packed binary tokens
+          aps_dict   the notification dict sent to every token
+          priority   OPTIONAL, 'high', 'normal' or 'bulk'
+      Returns:
+          None
+    """
+    service = get_service(app_id, provider)
+    if not hasattr(service, 'broadcast'):
+      raise xmlrpc.Fault(400, 'Provider %s does not support broadcast' % provider)
+    kwargs = priority_kwargs(service, provider, priority)
+    try:
+      d = service.broadcast(tokens.data, aps_dict, **kwargs)
+    except ValueError, e:
+      raise xmlrpc.Fault(400, str(e))
+    def _finish_err(r):
+      raise xmlrpc.Fault(500, 'Connection to the PNS server could not be made.')
+    return d.addCallbacks(lambda r: None, _finish_err)
+
+  def xmlrpc_reactivate(self, app_id, provider, token_or_token_list,
+                        registered_at=None):
+    """ Tokens reported inactive by the feedback service or rejected by
+    the PNS are no longer sent to. Reactivates tokens the app saw register
+    again after they went dark.
+
+      Arguments:
+          app_id                the app_id the tokens belong to
+          token_or_token_list   token or list of tokens registered again
+          registered_at         datetime of the registration, now if omitted
+      Returns:
+          None
+    """
+    if registered_at is not None:
+      registered_at = time.mktime(registered_at.timetuple())
+    get_service(app_id, provider).reactivate(token_or_token_list, registered_at)
 
   def xmlrpc_feedback(self, app_id, provider):
     """ Queries the Apple APNS feedback server for inactive app tokens. Returns
@@ -42,8 +195,69 @@ class PNSServer(xmlrpc.XMLRPC):
           Feedback tuples like (datetime_expired, token_str)
     """
 
-    return get_service(app_id, provider).feedback().addCallback(
-      lambda r: decode_feedback(r))
+    return get_service(app_id, provider).feedback()
+
+  def xmlrpc_reload_certificate(self, app_id, path_to_cert_or_cert=None):
+    """ Swaps the APNS certificate of a provisioned app, or reloads it
+    from its file. Notifications already queued are not disturbed, the new
+    certificate is used from the next connection on.
+
+      Arguments:
+          app_id                 the app_id to rotate the certificate of
+          path_to_cert_or_cert   OPTIONAL, path of the new .pem file or a
+                                 string containing it
+      Returns:
+          None
+    """
+    try:
+      get_service(app_id, 'apns').reload_certificate(path_to_cert_or_cert)
+    except (IOError, SSL.Error, crypto.Error), e:
+      raise xmlrpc.Fault(400, 'Could not load the certificate: %s' % e)
+
+  def xmlrpc_stats(self, app_id=None):
+    """ Reports the counters, gauges and histograms of the services.
+
+      Arguments:
+          app_id   OPTIONAL, only report the metrics of this app_id
+      Returns:
+          Dict of 'name{labels}' to values
+    """
+
+    return stats.snapshot(app_id)
+
+  def xmlrpc_provision_all(self, apps, warm_up=False):
+    """ Provisions many apps at once, loading their certificates in
+    parallel. Apps already provisioned are skipped.
+
+      Arguments:
+          apps      list of dicts with the app_id, provider ('apns' by
+                    default) and the provision options of the app, like
+                    cert, environment, timeout and pool_size
+          warm_up   OPTIONAL, connect every app to its gateway before
+                    returning
+      Returns:
+          Dict of app_id to 'ready', 'timeout' when the connection didn't
+          come up in time, or the error provisioning failed with
+    """
+    return create_services(apps, warm_up)
+
+  def xmlrpc_ready(self):
+    """ Whether the apps of the config are provisioned, and connected if
+    they were warmed up.
+
+      Returns:
+          Boolean
+    """
+    return self.ready
+
+def priority_kwargs(service, provider, priority):
+  if priority is None:
+    return {}
+  if not isinstance(service, APNSService):
+    raise xmlrpc.Fault(400, 'Provider %s does not support priorities' % provider)
+  if priority not in LANES:
+    raise xmlrpc.Fault(400, 'Unknown priority %r' % priority)
+  return {'priority': priority}
 
 def decode_feedback(binary_tuples):
   """ Returns a list of tuples in (datetime, token_str) format 
@@ -51,9 +265,4 @@ def decode_feedback(binary_tuples):
         binary_tuples   the binary-encoded feedback tuples
   """
 
-  fmt = '!lh32s'
-  size = struct.calcsize(fmt)
-  with StringIO(binary_tuples) as f:
-    return [(datetime.datetime.fromtimestamp(ts), binascii.hexlify(tok))
-            for ts, toklen, tok in (struct.unpack(fmt, tup) 
-                              for tup in iter(lambda: f.read(size), ''))]
+  return list(iter_feedback([binary_tuples]))
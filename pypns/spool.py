@@ -0,0 +1,221 @@
+import os
+import re
+import mmap
+import zlib
+import bisect
+import struct
+from twisted.python import log
+from twisted.internet import reactor, defer
+
+# crc32 of the expiry, token and payload, expiry, payload length
+RECORD = struct.Struct('!IIH')
+EXPIRY = struct.Struct('!I')
+CHECKPOINT = struct.Struct('!Q')
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_NAME = '%020d.seg'
+SEGMENT_RE = re.compile(r'^(\d{20})\.seg$')
+CHECKPOINT_NAME = 'checkpoint'
+SAVE_DELAY = 1
+
+
+class Spool(object):
+    """ An append-only log of (binary token, JSON payload, expiry)
+    notifications, kept in memory mapped segment files in `path`.
+
+    Entries are addressed by their offset in the log. `append` returns
+    the (start, end) range it wrote, and once that range is delivered
+    `ack` advances the checkpoint over it; delivery may complete out of
+    order. Segments wholly behind the checkpoint are deleted, everything
+    after it is returned by `unacked` to be replayed after a restart.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, sync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync = sync
+        self.segments = {}
+        self.acked = {}
+        # (position, deferred) fired once the checkpoint reaches position
+        self.waiters = []
+        self.save_call = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        indexes = sorted(int(m.group(1)) // segment_size
+                         for m in map(SEGMENT_RE.match, os.listdir(path)) if m)
+        self.checkpoint = self.load_checkpoint()
+        if indexes and self.checkpoint < indexes[0] * segment_size:
+            self.checkpoint = indexes[0] * segment_size
+        self.tail = self.checkpoint
+        if indexes:
+            self.tail = max(self.checkpoint, self.scan(indexes[-1]))
+        self.compact(indexes)
+
+    def append(self, records, expiry=0):
+        """ Writes the (token, payload) records, returns the (start, end)
+        range they take and how many they are. Nothing is kept when the
+        records raise. """
+        start = self.tail
+        count = 0
+        size = self.segment_size
+        seed = zlib.crc32(EXPIRY.pack(expiry))
+        try:
+            for token, payload in records:
+                body = token + payload
+                record = RECORD.pack(zlib.crc32(body, seed) & 0xffffffff,
+                                     expiry, len(payload)) + body
+                index, offset = divmod(self.tail, size)
+                if offset + len(record) > size:
+                    index, offset = index + 1, 0
+                segment = self.segment(index)
+                segment[offset:offset + len(record)] = record
+                self.tail = index * size + offset + len(record)
+                count += 1
+        except Exception:
+            self.truncate(start)
+            raise
+        if self.sync and count:
+            for index in xrange(start // size, (self.tail - 1) // size + 1):
+                self.segment(index).flush()
+        return start, self.tail, count
+
+    def read(self, start, end):
+        "Lazily yields the (token, payload, expiry) records of a range"
+        for position, token, payload, expiry in self.records(start, end):
+            yield token, payload, expiry
+
+    def records(self, start, end):
+        """ Lazily yields the (end, token, payload, expiry) records of a
+        range, `end` being the offset right after the record """
+        size = self.segment_size
+        position = start
+        while position < end:
+            index, offset = divmod(position, size)
+            record = read_record(self.segment(index), offset)
+            if record is None:
+                # the rest of the segment is unused
+                position = (index + 1) * size
+                continue
+            expiry, token, payload, length = record
+            position += length
+            yield position, token, payload, expiry
+
+    def ack(self, start, end):
+        "The records of the range were delivered"
+        if start == end:
+            return
+        self.acked[start] = end
+        checkpoint = self.checkpoint
+        while checkpoint in self.acked:
+            checkpoint = self.acked.pop(checkpoint)
+        if checkpoint != self.checkpoint:
+            self.checkpoint = checkpoint
+            self.compact(sorted(self.segments))
+            self.save_later()
+            while self.waiters and self.waiters[0][0] <= checkpoint:
+                self.waiters.pop(0)[1].callback(None)
+
+    def acked_through(self, position):
+        "Fires once everything before `position` was delivered"
+        if position <= self.checkpoint:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        bisect.insort(self.waiters, (position, d))
+        return d
+
+    def unacked(self):
+        "The (start, end, count) range of everything after the checkpoint"
+        count = sum(1 for _ in self.read(self.checkpoint, self.tail))
+        return self.checkpoint, self.tail, count
+
+    def segment(self, index):
+        "The mmap of segment `index`, created if needed"
+        segment = self.segments.get(index)
+        if segment is None:
+            name = os.path.join(self.path, SEGMENT_NAME % (index * self.segment_size))
+            fd = os.open(name, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                if os.fstat(fd).st_size < self.segment_size:
+                    os.ftruncate(fd, self.segment_size)
+                segment = mmap.mmap(fd, self.segment_size)
+            finally:
+                os.close(fd)
+            self.segments[index] = segment
+        return segment
+
+    def scan(self, index):
+        "Returns the offset right after the last whole record of a segment"
+        segment = self.segment(index)
+        offset = 0
+        while True:
+            record = read_record(segment, offset)
+            if record is None:
+                return index * self.segment_size + offset
+            offset += record[3]
+
+    def truncate(self, position):
+        "Drops the records from `position` on, the tail goes back there"
+        size = self.segment_size
+        first, offset = divmod(position, size)
+        for index in sorted(i for i in self.segments if i > first):
+            self.segments.pop(index).close()
+            os.remove(os.path.join(self.path, SEGMENT_NAME % (index * size)))
+        if first in self.segments and offset + RECORD.size <= size:
+            # scans stop at the first record that doesn't check out
+            self.segments[first][offset:offset + RECORD.size] = '\0' * RECORD.size
+        self.tail = position
+
+    def compact(self, indexes):
+        "Deletes the segments the checkpoint moved past"
+        last = self.tail // self.segment_size
+        for index in indexes:
+            if (index + 1) * self.segment_size > self.checkpoint or index >= last:
+                continue
+            segment = self.segments.pop(index, None)
+            if segment is not None:
+                segment.close()
+            os.remove(os.path.join(self.path, SEGMENT_NAME % (index * self.segment_size)))
+            log.msg('Spool compacted segment %d of %s' % (index, self.path))
+
+    def load_checkpoint(self):
+        name = os.path.join(self.path, CHECKPOINT_NAME)
+        if not os.path.exists(name):
+            return 0
+        with open(name, 'rb') as f:
+            return CHECKPOINT.unpack(f.read(CHECKPOINT.size))[0]
+
+    def save(self):
+        "Atomically write the checkpoint"
+        self.save_call = None
+        name = os.path.join(self.path, CHECKPOINT_NAME)
+        with open(name + '.tmp', 'wb') as f:
+            f.write(CHECKPOINT.pack(self.checkpoint))
+        os.rename(name + '.tmp', name)
+
+    def save_later(self, delay=SAVE_DELAY):
+        "Coalesce the checkpoint writes of many acks into one"
+        if self.save_call is None:
+            self.save_call = reactor.callLater(delay, self.save)
+
+    def close(self):
+        if self.save_call is not None and self.save_call.active():
+            self.save_call.cancel()
+        self.save()
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+
+
+def read_record(segment, offset):
+    """ Returns the (expiry, token, payload, record length) at `offset`, or
+    None past the last whole record """
+    if offset + RECORD.size + 32 > len(segment):
+        return None
+    crc, expiry, length = RECORD.unpack_from(segment, offset)
+    end = offset + RECORD.size + 32 + length
+    if length == 0 or end > len(segment):
+        return None
+    body = segment[offset + RECORD.size:end]
+    if zlib.crc32(body, zlib.crc32(EXPIRY.pack(expiry))) & 0xffffffff != crc:
+        # a torn write
+        return None
+    return expiry, body[:32], body[32:], end - offset
@@ -0,0 +1,177 @@
+import bisect
+import itertools
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+BUCKETS = {
+    'connect_seconds': LATENCY_BUCKETS,
+    'request_seconds': LATENCY_BUCKETS,
+    'feedback_records': SIZE_BUCKETS,
+}
+
+PREFIX = 'pypns_'
+MAXINT = 2 ** 31 - 1
+
+# (name, labels) -> value
+counters = {}
+# (name, labels) -> Histogram
+histograms = {}
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self):
+        "Yields the cumulative (upper bound, count) of every bucket"
+        bounds = itertools.chain(self.buckets, ['+Inf'])
+        return itertools.izip(bounds, accumulate(self.counts))
+
+
+class Metrics(object):
+    """ The counters and histograms of one service, labelled with its
+    provider and app_id. Counters are plain dict updates so they are cheap
+    enough for the hot paths. """
+
+    def __init__(self, provider, app_id=None):
+        self.labels = (('app', app_id or ''), ('provider', provider))
+
+    def incr(self, name, value=1, **labels):
+        key = (name, self.labels + tuple(sorted(labels.items()))
+               if labels else self.labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, self.labels + tuple(sorted(labels.items()))
+               if labels else self.labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(
+                BUCKETS.get(name, LATENCY_BUCKETS))
+        histogram.observe(value)
+
+
+def gauges():
+    "Yields the (name, labels, value) of the gauges read off the services"
+    from pypns.base import services
+    for app_id, providers in services.items():
+        for provider, service in providers.items():
+            labels = (('app', app_id), ('provider', provider))
+            if hasattr(service, 'queue_depth'):
+                yield 'queue_depth', labels, service.queue_depth
+            if hasattr(service, 'clients'):
+                yield 'connections', labels, len(service.clients())
+            if hasattr(service, 'inactive'):
+                yield 'inactive_tokens', labels, len(service.inactive)
+            if hasattr(service, 'pacing_active'):
+                yield 'pacing_active', labels, int(service.pacing_active)
+
+
+def collect(app_id=None):
+    """ Returns the (type, name, [(labels, value), ...]) of every metric,
+    only those of `app_id` when given. Histograms are expanded into their
+    _bucket, _sum and _count series. """
+    def wanted(labels):
+        return app_id is None or labels[0][1] == app_id
+
+    metrics = {}
+    def add(kind, name, labels, value):
+        metrics.setdefault((name, kind), []).append((labels, value))
+
+    for (name, labels), value in counters.items():
+        if wanted(labels):
+            add('counter', name + '_total', labels, value)
+    for name, labels, value in gauges():
+        if wanted(labels):
+            add('gauge', name, labels, value)
+    for (name, labels), histogram in histograms.items():
+        if wanted(labels):
+            for bound, count in histogram.samples():
+                add('histogram', name + '_bucket', labels + (('le', bound),), count)
+            add('histogram', name + '_sum', labels, histogram.sum)
+            add('histogram', name + '_count', labels, histogram.count)
+    return [(kind, name, sorted(samples))
+            for (name, kind), samples in sorted(metrics.items())]
+
+
+def snapshot(app_id=None):
+    """ A flat {'name{labels}': value} dict of every sample, suitable for
+    XML-RPC (large integers are sent as doubles) """
+    result = {}
+    for kind, name, samples in collect(app_id):
+        for labels, value in samples:
+            if isinstance(value, (int, long)) and value > MAXINT:
+                value = float(value)
+            result[sample_name(name, labels)] = value
+    return result
+
+
+def render_text(app_id=None):
+    "The metrics in the Prometheus text exposition format"
+    lines = []
+    for kind, name, samples in collect(app_id):
+        family = name
+        if kind == 'histogram':
+            family = name.rsplit('_', 1)[0]
+        type_line = '# TYPE %s%s %s' % (PREFIX, family, kind)
+        if type_line not in lines:
+            lines.append(type_line)
+        for labels, value in samples:
+            lines.append('%s%s %s' % (PREFIX, sample_name(name, labels),
+                                      format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def merge_text(texts):
+    "Merges the render_text of several processes family by family"
+    families = {}
+    order = []
+    for text in texts:
+        samples = None
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                samples = families.get(line)
+                if samples is None:
+                    samples = families[line] = []
+                    order.append(line)
+            elif line:
+                samples.append(line)
+    lines = []
+    for type_line in sorted(order):
+        lines.append(type_line)
+        lines.extend(families[type_line])
+    return '\n'.join(lines) + '\n'
+
+
+def sample_name(name, labels):
+    return '%s{%s}' % (name, ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def accumulate(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+def reset():
+    counters.clear()
+    histograms.clear()
@@ -0,0 +1,220 @@
+import json
+import itertools
+from twisted.python import log
+from twisted.internet import defer
+from twisted.web import resource, server
+from pypns import jobs, stats
+from pypns.base import create_service, get_service, has_service
+from pypns.apns.client import APNSService, PRIORITY_NORMAL, iter_binary_tokens
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+NDJSON = 'application/x-ndjson'
+MSGPACK = 'application/x-msgpack'
+
+class BadRequest(Exception):
+    pass
+
+class PNSResource(resource.Resource):
+    """ A lightweight alternative to the XML-RPC interface. Notifications
+    are posted as newline delimited JSON or a stream of msgpack records,
+    either {"token": token, "notification": notification} maps or
+    [token, notification] pairs, and parsed as they are encoded.
+
+        POST /notify/<app_id>/<provider>?priority=<high|normal|bulk>
+        POST /notify/<app_id>/<provider>?accept=1  {"count": n, "job_id": id}
+        POST /provision        {"app_id": ..., "provider": ..., options...}
+        GET  /feedback/<app_id>/<provider>  ["datetime", token] lines
+        GET  /status/<job_id>?wait=<seconds>
+    """
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        path = [p for p in request.postpath if p]
+        if len(path) == 3 and path[0] == 'notify':
+            return self.notify(request, path[1], path[2])
+        if path == ['provision']:
+            return self.provision(request)
+        return self.error(request, 404, 'Not found')
+
+    def render_GET(self, request):
+        path = [p for p in request.postpath if p]
+        if len(path) == 3 and path[0] == 'feedback':
+            return self.feedback(request, path[1], path[2])
+        if len(path) == 2 and path[0] == 'status':
+            return self.status(request, path[1])
+        return self.error(request, 404, 'Not found')
+
+    def notify(self, request, app_id, provider):
+        try:
+            service = get_service(app_id, provider)
+        except Exception, e:
+            return self.error(request, 404, str(e))
+        try:
+            count = count_records(request)
+            pairs = (record_pair(r) for r in iter_records(request))
+        except BadRequest, e:
+            return self.error(request, 415, str(e))
+
+        priority = request.args.get('priority', [None])[0]
+        accept = request.args.get('accept', [None])[0]
+        if isinstance(service, APNSService):
+            # feed the encoder straight from the request body
+            tokens, payloads = itertools.tee(pairs)
+            try:
+                d = service.write(iter_binary_tokens(t for t, _ in tokens),
+                                  (p for _, p in payloads), count,
+                                  priority=priority or PRIORITY_NORMAL,
+                                  delivered=bool(accept))
+            except ValueError, e:
+                return self.error(request, 400, str(e))
+        elif priority is not None:
+            return self.error(request, 400,
+                              'Provider %s does not support priorities' % provider)
+        else:
+            pairs = list(pairs)
+            d = defer.maybeDeferred(service.notify, [t for t, _ in pairs],
+                                    [p for _, p in pairs])
+
+        # the body is encoded as the gateway drains, possibly after the
+        # request finished or its client went away, and Twisted closes
+        # request.content then, so keep it open until the encoder is done
+        content, request.content = request.content, None
+        def _close(r):
+            content.close()
+            return r
+        d.addBoth(_close)
+
+        if accept:
+            # answer once queued, status/<job_id> tells how it went
+            job = jobs.table.add(app_id, provider, count, d)
+            if job.state == jobs.FAILED and job.error is not None:
+                return self.error(request, 503, job.error)
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({'count': count, 'job_id': job.job_id})
+
+        def _done(r):
+            if type(r) is list:
+                return {'count': count, 'results': r}
+            return {'count': count}
+        return self.respond(request, d.addCallback(_done))
+
+    def provision(self, request):
+        try:
+            options = dict((str(k), v) for k, v in
+                           json.loads(request.content.read()).iteritems())
+            app_id, provider = options.pop('app_id'), options.pop('provider', 'apns')
+        except (ValueError, KeyError, AttributeError), e:
+            return self.error(request, 400, 'Invalid provision request %s' % e)
+        if not has_service(app_id, provider):
+            create_service(app_id, provider, **options)
+        return self.respond(request, defer.succeed(None))
+
+    def feedback(self, request, app_id, provider):
+        try:
+            service = get_service(app_id, provider)
+        except Exception, e:
+            return self.error(request, 404, str(e))
+        # stream the records as newline delimited JSON while they arrive
+        request.setHeader('Content-Type', NDJSON)
+        def _write(records):
+            request.write(''.join('%s\n' % json.dumps([dt.isoformat(), token])
+                                  for dt, token in records))
+        d = service.feedback(consumer=_write)
+        def _finish(r):
+            request.finish()
+        def _finish_err(err):
+            log.msg('PNSResource feedback error %s' % err.getErrorMessage())
+            request.loseConnection()
+        d.addCallbacks(_finish, _finish_err)
+        return server.NOT_DONE_YET
+
+    def status(self, request, job_id):
+        try:
+            job = jobs.table.get(job_id)
+        except jobs.UnknownJobException, e:
+            return self.error(request, 404, str(e))
+        try:
+            wait = float(request.args.get('wait', [0])[0])
+        except ValueError:
+            return self.error(request, 400, 'Invalid wait')
+        return self.respond(request, job.wait(wait))
+
+    def respond(self, request, d):
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def _write(result):
+            if finished:
+                return
+            request.setHeader('Content-Type', 'application/json')
+            request.write(json.dumps(result))
+            request.finish()
+
+        def _write_err(err):
+            log.msg('PNSResource error %s' % err.getErrorMessage())
+            if finished:
+                return
+            request.setResponseCode(500)
+            _write({'error': err.getErrorMessage()})
+
+        d.addCallbacks(_write, _write_err)
+        return server.NOT_DONE_YET
+
+    def error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'error': message})
+
+class MetricsResource(resource.Resource):
+    """ The metrics of every service in the Prometheus text format,
+    GET /metrics?app_id=<app_id> narrows them down to one app """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        app_id = request.args.get('app_id', [None])[0]
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return stats.render_text(app_id)
+
+def record_pair(record):
+    if isinstance(record, dict):
+        return record['token'], record['notification']
+    token, notification = record
+    return token, notification
+
+def content_type(request):
+    return (request.getHeader('content-type') or NDJSON).split(';')[0]
+
+def iter_records(request):
+    "Lazily parses the records of the request body"
+    request.content.seek(0)
+    if content_type(request) == MSGPACK:
+        if msgpack is None:
+            raise BadRequest('msgpack is not installed')
+        return msgpack.Unpacker(request.content, raw=False)
+    if content_type(request) in (NDJSON, 'application/json'):
+        return (json.loads(line) for line in request.content if line.strip())
+    raise BadRequest('Unsupported content type %s' % content_type(request))
+
+def count_records(request):
+    "Counts the records of the request body without decoding them"
+    request.content.seek(0)
+    count = 0
+    if content_type(request) == MSGPACK and msgpack is not None:
+        unpacker = msgpack.Unpacker(request.content)
+        try:
+            while True:
+                unpacker.skip()
+                count += 1
+        except msgpack.OutOfData:
+            pass
+    else:
+        for line in request.content:
+            if line.strip():
+                count += 1
+    return count
@@ -0,0 +1,244 @@
+import json
+import time
+import urllib
+import urlparse
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.web.http_headers import Headers
+from zope.interface import implements
+from pypns import base
+from pypns.base import IPNSService
+from pypns.httppush import HTTPPushService, BufferProtocol, BufferProducer
+from pypns.inactive import digest_token
+from pypns.pacing import TokenBucket
+from pypns.stats import Metrics
+
+LOGIN_URL = 'https://login.live.com/accesstoken.srf'
+SCOPE = 'notify.windows.com'
+# channel URIs are only trusted with the access token on these hosts
+CHANNEL_DOMAIN = '.notify.windows.com'
+MAX_CONNECTIONS_PER_HOST = 32
+CONCURRENCY = 32
+# tokens are refreshed that many seconds before they expire
+TOKEN_MARGIN = 300
+# throttled (406) and unavailable (503) sends are retried that many times,
+# waiting RETRY_DELAY doubling every attempt
+MAX_RETRIES = 3
+RETRY_DELAY = 1.0
+
+TYPE_TOAST = 'wns/toast'
+TYPE_TILE = 'wns/tile'
+TYPE_BADGE = 'wns/badge'
+TYPE_RAW = 'wns/raw'
+TYPES = (TYPE_TOAST, TYPE_TILE, TYPE_BADGE, TYPE_RAW)
+
+class UnauthorizedException(Exception):
+    pass
+
+class ChannelExpiredException(Exception):
+    pass
+
+class ThrottledException(Exception):
+    pass
+
+class ServiceUnavailableException(Exception):
+    pass
+
+class WNSException(Exception):
+    pass
+
+class WNSService(HTTPPushService):
+    """
+    A Service that sends notifications to the Windows Push Notification
+    Service. Tokens are channel URIs, and notifications either XML strings
+    sent as toasts or dicts with the `content` and optionally the `type`
+    ('wns/toast', 'wns/tile', 'wns/badge' or 'wns/raw'), `ttl` and `tag`.
+    """
+    implements(IPNSService)
+
+    ERRORS = {
+        401: UnauthorizedException,
+        404: ChannelExpiredException,
+        406: ThrottledException,
+        410: ChannelExpiredException,
+        503: ServiceUnavailableException,
+    }
+
+    def __init__(self, client_id, client_secret, environment=None, timeout=15,
+                 inactive_path=None,
+                 max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                 concurrency=CONCURRENCY, login_url=LOGIN_URL,
+                 channel_domain=CHANNEL_DOMAIN, rate=None, burst=None,
+                 max_retries=MAX_RETRIES):
+        log.msg('WNSService __init__')
+        # channel URIs answered with 404 or 410 are not sent again
+        HTTPPushService.__init__(self, inactive_path, max_connections_per_host,
+                                 concurrency)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.environment = environment
+        self.timeout = timeout
+        self.login_url = login_url
+        self.channel_domain = channel_domain
+        self.token_expires = 0
+        # replaced by one labelled with the app_id in create_service
+        self.metrics = Metrics('wns')
+        # sends/s, slowed down when WNS throttles
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+
+    @property
+    def pacing_active(self):
+        return self.bucket is not None and self.bucket.active
+
+    @defer.inlineCallbacks
+    def notify_one(self, channel, payload):
+        if base.DEBUG:
+            log.msg('WNSService.notify %s' % channel)
+
+        if self.inactive.count and digest_token(channel) in self.inactive:
+            self.metrics.incr('notifications_suppressed')
+            raise ChannelExpiredException('Channel %s is inactive' % channel)
+        self.check_channel(channel)
+
+        attempt = 0
+        while True:
+            if not self.token or time.time() > self.token_expires:
+                yield self.refresh_token()
+            yield self.pace()
+            token = self.token
+            try:
+                result = yield self.send_notify(channel, payload)
+            except UnauthorizedException:
+                yield self.refresh_token(token)
+                result = yield self.send_notify(channel, payload)
+            except (ThrottledException, ServiceUnavailableException):
+                self.backoff()
+                if attempt >= self.max_retries:
+                    raise
+                delay = RETRY_DELAY * 2 ** attempt
+                attempt += 1
+                self.metrics.incr('retries')
+                yield task.deferLater(reactor, delay, lambda: None)
+                continue
+            defer.returnValue(result)
+
+    def check_channel(self, channel):
+        "Refuse to hand the access token to hosts other than WNS"
+        if self.channel_domain is None:
+            return
+        url = urlparse.urlparse(channel)
+        if url.scheme != 'https' or not (url.hostname or '').endswith(self.channel_domain):
+            raise ValueError('Not a WNS channel URI: %s' % channel)
+
+    def pace(self):
+        "Fires once another send may start"
+        if self.bucket is None or self.bucket.available(1):
+            if self.bucket is not None:
+                self.bucket.take(1)
+            return defer.succeed(None)
+        self.metrics.incr('pacing_waits')
+        return task.deferLater(reactor, self.bucket.delay(), self.pace)
+
+    def backoff(self):
+        "WNS throttled us, slow every send down"
+        self.metrics.incr('pacing_backoffs')
+        if self.bucket is not None:
+            self.bucket.backoff()
+            log.msg('WNSService backing off to %.1f sends/s' % self.bucket.rate)
+
+    def use_token(self, result):
+        token, expires_in = result
+        self.token = token
+        self.token_expires = time.time() + max(0, expires_in - TOKEN_MARGIN)
+
+    @defer.inlineCallbacks
+    def send_notify(self, channel, payload):
+        if isinstance(payload, basestring):
+            payload = {'content': payload}
+        kind = payload.get('type', TYPE_TOAST)
+        if kind not in TYPES:
+            raise ValueError('Unknown WNS notification type %r' % kind)
+        body = payload['content']
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        headers = {
+            'Authorization': ['Bearer ' + self.token],
+            'Content-Type': ['application/octet-stream' if kind == TYPE_RAW
+                             else 'text/xml'],
+            'X-WNS-Type': [kind]}
+        if payload.get('ttl') is not None:
+            headers['X-WNS-TTL'] = [str(payload['ttl'])]
+        if payload.get('tag') is not None:
+            headers['X-WNS-Tag'] = [payload['tag'].encode('utf-8')]
+
+        if isinstance(channel, unicode):
+            channel = channel.encode('utf-8')
+        started = time.time()
+        response = yield self.agent.request(
+            'POST', channel, Headers(headers), BufferProducer(body))
+
+        # always read the body so the connection goes back to the pool
+        protocol = BufferProtocol()
+        response.deliverBody(protocol)
+        yield protocol.done
+
+        self.metrics.observe('request_seconds', time.time() - started)
+        self.metrics.incr('responses', code=response.code)
+        self.metrics.incr('bytes_sent', len(body))
+
+        if response.code != 200:
+            self.metrics.incr('errors', code=response.code)
+            error = self.ERRORS.get(response.code, WNSException)
+            if error is ChannelExpiredException:
+                self.markInactive(channel)
+            raise error('Error sending notification %d %s' % (
+                response.code, header(response, 'x-wns-error-description') or ''))
+
+        if base.DEBUG:
+            log.msg('WNSService.response %s %s' % (
+                channel, header(response, 'x-wns-status')))
+
+        self.metrics.incr('notifications_sent')
+        defer.returnValue(header(response, 'x-wns-status') or 'received')
+
+    def feedback(self):
+        "WNS reports expired channels on send, there is no feedback service"
+        return defer.succeed([])
+
+    @defer.inlineCallbacks
+    def get_token(self):
+        "Returns an OAuth access token and the seconds it is valid for"
+        log.msg('WNSService.get_token')
+
+        values = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'scope': SCOPE,
+        }
+        response = yield self.agent.request(
+            'POST',
+            self.login_url,
+            Headers({
+                'Content-Type': ['application/x-www-form-urlencoded']
+            }),
+            BufferProducer(urllib.urlencode(values)))
+
+        protocol = BufferProtocol()
+        response.deliverBody(protocol)
+        response_content = yield protocol.done
+
+        if response.code != 200:
+            raise UnauthorizedException(
+                'Access token request failed %d %s' % (response.code, response_content))
+        token = json.loads(response_content)
+        defer.returnValue((token['access_token'].encode('utf-8'),
+                           int(token.get('expires_in', 86400))))
+
+def header(response, name):
+    values = response.headers.getRawHeaders(name)
+    return values[0] if values else None
@@ -17,7 +17,7 @@ setup(
     'Operating System :: OS Independent',
     'Programming Language :: Python',
     'Topic :: Software Development :: Libraries :: Python Modules'],
-  packages=find_packages(),
+  packages=find_packages(exclude=['benchmarks']),
   package_data={},
-  install_requires=['Twisted>=8.2.0', 'pyOpenSSL>=0.10']
+  install_requires=['Twisted>=14.0', 'pyOpenSSL>=0.14']
 )